@@ -1,12 +1,64 @@
 """
 Agrona - the MobServ monitoring system
 """
-from   mwacs          import parsing
-from   event.base     import Listener, Notifier
-from   event.handling import EventHandler
-from   urllib         import urlopen
-from   time           import sleep
-import logging, config, xmlrpclib, socket
+import time
+STARTED = time.time()   # So we can tell how long we took to get going
+
+from   mwacs            import parsing, decoding
+from   mwacs.sweeping   import Sweeper
+from   mwacs.entities   import MWACSHost
+from   event.base       import Listener, Notifier
+from   event.handling   import EventHandler, DigestEventHandler
+from   event.outbox     import Outbox, OutboxSender
+from   threading        import Thread, Timer
+from   time             import sleep
+import logging, config
+
+class DeadlineReader:
+    """
+    Wraps the response from the feed's server so that reading it fails once
+    a time limit has passed. A socket timeout only limits each read from
+    the socket, so a feed that trickles in a few bytes at a time could
+    otherwise keep us waiting indefinitely. When the limit is reached the
+    connection is shut down, so that even a read in progress gives up
+    """
+
+    def __init__(self, response, limit):
+        """
+        Starts the clock on a response
+
+        response
+            The response from urllib2.urlopen
+
+        limit
+            The seconds that reading the response may take
+        """
+        self.response = response
+        self.expired  = False
+        self.timer    = Timer(limit, self.expire)
+        self.timer.setDaemon(True)
+        self.timer.start()
+
+    def expire(self):
+        """Called when the time is up; shuts down the connection"""
+        import socket
+        self.expired = True
+
+        # urllib2 wraps the HTTPResponse, which wraps the socket
+        try:
+            self.response.fp._sock.fp._sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error), e:
+            logging.debug("Couldn't shut down the feed's connection: " + str(e))
+
+    def read(self, size=-1):
+        if not self.expired: data = self.response.read(size)
+        if self.expired:
+            raise IOError("MWACS feed took too long to arrive")
+        return data
+
+    def cancel(self):
+        """Stops the clock, once we're done with the response"""
+        self.timer.cancel()
 
 class Agrona(Listener, Notifier):
     """
@@ -17,48 +69,201 @@ class Agrona(Listener, Notifier):
         """
         Initialises our Agrona instance
         """
-        self.url     = "http://www.mobserv.com/mwacs/status.php?cType=xml2"
+        self.url     = config.MWACS_URL
         self.running = False
-        logging.info("Running initial parse of MWACS data")
-        url          = urlopen(self.url)
-        self.hosts   = parsing.parse(url, None)
 
-        # We need to register this an event handler as a listener with all hosts
-        self.eventHandler = EventHandler()
-        for host in self.hosts.values():
-            host.addListener(self.eventHandler, True)
+        # Flap detection is optional. Each host we find is given our
+        # detector, which watches its conditions and its processes'
+        if config.FLAP_DETECTION:
+            from mwacs.flapping import FlapDetector
+            self.detector = FlapDetector()
+        else:
+            self.detector = None
+        self.sweeper = Sweeper(detector=self.detector)
+
+        # We start with no hosts at all; the first iteration of the main loop
+        # finds them all, so nothing here has to wait on the network
+        self.hosts   = {}
+
+        # Memory profiling is optional, and off by default. Its modules (and
+        # the change feed's) are only imported if they're wanted
+        self.profiler = None
+        if config.PROFILE_MEMORY:
+            from profiling import CycleProfiler
+            try:
+                self.profiler = CycleProfiler()
+            except (IOError, OSError), e:
+                logging.error("Unable to open the memory profile log; not "
+                              "profiling: " + str(e))
+
+        # Other tools can follow the changes we see through the change feed
+        if config.CHANGE_FEED:
+            from mwacs.publishing import ChangeFeed
+            self.changeFeed = ChangeFeed()
+            self.changeFeed.start()
+        else:
+            self.changeFeed = None
+
+        # Alerts are spooled to the outbox and sent from a separate thread, so
+        # that a broken gateway never holds up the main loop
+        self.outbox       = Outbox()
+        self.sender       = OutboxSender(self.outbox)
+        self.sender.start()
+
+        # The event handler is registered with each host as it turns up
+        if config.DIGEST_ALERTS:
+            self.eventHandler = DigestEventHandler(self.outbox)
+        else:
+            self.eventHandler = EventHandler(self.outbox)
+
+    def fetch(self, hosts, changes=None, timeout=None, limit=None):
+        """
+        Fetches the MWACS feed and parses it, using whichever decoder suits
+        the format it's served in
+
+        hosts
+            The hosts to update, or None to create them afresh
+
+        changes
+            (Optional) A list to which the changes made to the hosts are
+            appended
+
+        timeout
+            (Optional) Seconds to wait on the feed's server for each read.
+            Defaults to config.FETCH_TIMEOUT
+
+        limit
+            (Optional) Seconds the whole fetch may take, however quickly the
+            feed's server answers each read. Defaults to no limit
+        """
+        if timeout is None: timeout = config.FETCH_TIMEOUT
+
+        # urllib2 drags in most of the networking modules, so we leave
+        # importing it until we need it
+        from urllib2 import urlopen
+
+        started  = time.time()
+        response = urlopen(self.url, timeout=timeout)
+        decoder  = decoding.getDecoder(response.info().gettype(), self.url)
+        if limit is None:
+            return parsing.parse(response, hosts, decoder, changes)
+
+        # The limit counts the time spent getting a response, too
+        remaining = max(0, limit - (time.time() - started))
+        source    = DeadlineReader(response, remaining)
+        try:
+            return parsing.parse(source, hosts, decoder, changes)
+        finally:
+            source.cancel()
 
     def run(self):
         """
         Runs the main loop of the agrona process
         """
         self.running = True
+
+        # Everything else is up by now, so we're ready for business
+        ready = time.time() - STARTED
+        if ready > config.READY_TARGET:
+            logging.warning("Ready in %.3fs, over our target of %.3fs" \
+                            % (ready, config.READY_TARGET))
+        else:
+            logging.info("Ready in %.3fs" % ready)
+
+        # The first fetch happens in the background, so that a slow feed
+        # can't hold up startup
+        first = Thread(target=self.firstCycle, name="FirstFetch")
+        first.setDaemon(True)
+        first.start()
+
         while (self.running):
             sleep(config.SLEEP_TIME)
-            logging.info("Running main loop")
-            self.hosts = parsing.parse(urlopen(self.url), self.hosts)
 
-            # Update MWACS; let it know we're still going
+            # Never run two iterations at once
+            if first.isAlive():
+                logging.warning("Still waiting on the first fetch of MWACS data")
+                continue
+
+            # A failed iteration mustn't take the daemon down; the next one
+            # will simply try again
             try:
-                server = xmlrpclib.ServerProxy(config.MWACS_WS_URL)
-                server.mwacs.logStatus("agrona", "running", socket.gethostname())
+                self.cycle()
             except Exception, e:
-                logging.error("Couldn't update MWACS entry: " + e)
+                logging.error("Main loop failed: " + str(e))
+
+    def firstCycle(self):
+        """
+        Runs the first iteration of the main loop, which finds all the hosts.
+        The whole fetch gets config.STARTUP_DEADLINE seconds, rather than
+        the usual config.FETCH_TIMEOUT for each read from the feed. If it
+        fails, the next iteration will simply try again
+        """
+        logging.info("Running initial parse of MWACS data")
+        try:
+            self.cycle(config.STARTUP_DEADLINE, config.STARTUP_DEADLINE)
+        except Exception, e:
+            logging.error("Initial parse of MWACS data failed: " + str(e))
 
-            # Some debugging
-            # TODO - Remove this once we're confident that everything works
-            # Or at least make sure that the log level is not DEBUG(!)
-            for host in self.hosts.values():
-                logging.debug("Host " + str(host))
+    def cycle(self, timeout=None, limit=None):
+        """
+        Runs a single iteration of the main loop
+
+        timeout
+            (Optional) Seconds to wait on the feed's server for each read.
+            Defaults to config.FETCH_TIMEOUT
+
+        limit
+            (Optional) Seconds the whole fetch may take. Defaults to no limit
+        """
+        logging.info("Running main loop")
+        changes    = []
+        self.hosts = self.fetch(self.hosts, changes, timeout, limit)
+
+        # Anything that's new to us needs our event handler too, and new
+        # hosts our flap detector
+        for op, entity in changes:
+            if op != 'new': continue
+            entity.addListener(self.eventHandler)
+            if isinstance(entity, MWACSHost): entity.detector = self.detector
+
+        # Drop anything that's been missing from the feed for too long
+        removed = self.sweeper.sweep(self.hosts)
+
+        if self.changeFeed is not None:
+            changes.extend([('removed', entity) for entity in removed])
+            self.changeFeed.publish(changes, self.hosts)
+
+        # In digest mode, this iteration's alerts all go out together
+        if config.DIGEST_ALERTS:
+            self.eventHandler.flush()
+
+        # Update MWACS; let it know we're still going
+        try:
+            import socket, xmlrpclib
+            server = xmlrpclib.ServerProxy(config.MWACS_WS_URL)
+            server.mwacs.logStatus("agrona", "running", socket.gethostname())
+        except Exception, e:
+            logging.error("Couldn't update MWACS entry: " + str(e))
+
+        if self.profiler is not None:
+            self.profiler.cycle(self.hosts)
+
+        # Some debugging
+        # TODO - Remove this once we're confident that everything works
+        # Or at least make sure that the log level is not DEBUG(!)
+        if not logging.getLogger().isEnabledFor(logging.DEBUG): return
+
+        for host in self.hosts.values():
+            logging.debug("Host " + str(host))
 
-                for prop in host.props.values():
-                    logging.debug("\tProperty " + str(prop))
+            for prop in host.props.values():
+                logging.debug("\tProperty " + str(prop))
 
-                for proc in host.procs.values():
-                    logging.debug("\tProcess " + str(proc))
+            for proc in host.procs.values():
+                logging.debug("\tProcess " + str(proc))
 
-                    for prop in proc.props.values():
-                        logging.debug("\t\tProperty " + str(prop))
+                for prop in proc.props.values():
+                    logging.debug("\t\tProperty " + str(prop))
 
 if __name__ == '__main__':
     # Set up our logging
@@ -23,8 +23,26 @@ ALERTS         = {                   # Message bodies for the alerts we send out
     'HostTimeout':
         "This is an alert from Agrona, the MobServ Monitoring Daemon.\n" +
         "%s was reported timed out at %s",
+    'ProcessFlapping':
+        "This is an alert from Agrona, the MobServ Monitoring Daemon.\n" +
+        "%s was reported flapping at %s; further alerts for it are " +
+        "suppressed until it settles",
+    # No HostFlapping: high load averages aren't alerted on, so a flapping
+    # one shouldn't be either
 }
 
+# Digest alerts: when DIGEST_ALERTS is set, the events from each iteration
+# are sent as a single summary, one line per host and event type
+DIGEST_ALERTS     = False
+DIGEST_HEADER     = (
+    "This is an alert digest from Agrona, the MobServ Monitoring Daemon.\n" +
+    "%(count)d events on %(hosts)d hosts were reported between %(start)s " +
+    "and %(end)s\n")
+DIGEST_LINE       = "%(host)s: %(eventType)s x%(count)d (%(names)s)"
+DIGEST_SMS_HEADER = "Agrona: %(count)d events on %(hosts)d hosts. "
+DIGEST_SMS_LINE   = "%(host)s %(eventType)s x%(count)d; "
+SMS_MAX_LENGTH    = 160              # The longest SMS we'll send
+
 # Sender details for alerts
 FROM_ADDR      = "agrona@monstermob.com"
 FROM_MSISDN    = "82468"
@@ -33,6 +51,52 @@ RECIPIENTS     = {                   # Recipients (email and sms) for the alerts
     'sms'   : (),
 }
 
+# Fetching the MWACS feed
+FETCH_TIMEOUT    = 30                # Seconds to wait on the feed's server
+STARTUP_DEADLINE = 10                # Seconds our first fetch of the feed may take in all
+READY_TARGET     = 0.5               # Seconds from startup to the main loop we aim for
+FETCH_CHUNK_SIZE = 16384             # Bytes read from the feed at a time
+FETCH_QUEUE_DEPTH = 16               # Chunks read ahead of the parser
+
+# Flap detection, to stop unstable hosts and processes flooding us with alerts
+FLAP_DETECTION   = True              # Whether to use flap detection at all
+LOAD_AVG_CLEAR   = 4                 # The load average below which a high load is over
+FLAP_DWELL       = 0                 # Seconds a condition must hold before we act on it
+FLAP_HALF_LIFE   = 900               # Seconds for a transition's weight to halve
+FLAP_START       = 4                 # Flap score at which we call something flapping
+FLAP_STOP        = 1.5               # Flap score below which it has settled
+
+# Eviction of hosts and processes that vanish from the feed
+HOST_TTL         = 86400             # Seconds a host may go unseen before it's dropped
+PROCESS_TTL      = 86400             # Seconds a process or property may go unseen
+SWEEP_BATCH      = 50                # Hosts checked for staleness on each iteration
+VANISHED_EVENTS  = True              # Whether dropping a host or process fires an event
+
+# The change feed, for other tools that want to follow MWACS state
+CHANGE_FEED        = False           # Whether to publish changes at all
+CHANGE_FEED_SOCKET = '/var/run/agrona/changes.sock' # Where subscribers connect
+CHANGE_FEED_BUFFER = 10000           # Records a subscriber may fall behind by
+
+# Alert outbox settings
+SPOOL_DIR        = '/var/spool/agrona' # Where alerts wait to be delivered
+SPOOL_MAX_ALERTS = 10000             # Most alerts to spool before dropping the oldest
+SEND_TIMEOUT     = 30                # Seconds to wait on the SMTP server or SMS gateway
+RETRY_BASE       = 15                # Seconds before the first retry of a failed alert
+RETRY_MAX        = 1800              # The longest we'll wait between retries
+RETRY_LIMIT      = 50                # Delivery attempts before an alert is abandoned
+BREAKER_FAILURES = 5                 # Consecutive failures before we stop trying a gateway
+BREAKER_RESET    = 120               # Seconds before we try a failed gateway again
+
+# Memory profiling, for tracking down slow leaks
+PROFILE_MEMORY    = False            # Whether to profile memory use at all
+PROFILE_EVERY     = 60               # Iterations between memory snapshots
+PROFILE_TOP       = 10               # Object types and allocation sites to report
+PROFILE_TRACE     = False            # Also trace allocations with tracemalloc (costly)
+PROFILE_FRAMES    = 1                # Stack frames tracemalloc records per allocation
+PROFILE_LOG       = '/var/log/agrona/memory.log'
+PROFILE_LOG_SIZE  = 1048576          # Bytes before the profile log is rotated
+PROFILE_LOG_COUNT = 5                # Rotated profile logs to keep
+
 # Logging settings
 LOG_FORMAT     = '%(asctime)s %(levelname)s %(message)s'
 LOG_LEVEL      = logging.DEBUG
@@ -2,11 +2,10 @@
 Event handling classes and functions for Agrona
 """
 from   base      import Listener
+from   outbox    import Outbox, OutboxSender
 from   datetime  import datetime
 import logging
 import config
-import smtplib
-import xmlrpclib
 
 class EventHandler(Listener):
     """
@@ -17,8 +16,35 @@ class EventHandler(Listener):
     kind of factory so that we can do more useful stuff when errors occur (like
     attempting to restart processes remotely perhaps? Hmm... could be
     permission issues there...)
+
+    Properties:
+
+    outbox
+        The Outbox that alerts are spooled to. Alerts are delivered from
+        there by an OutboxSender, so nothing in notify() waits on a gateway
+
+    sender
+        The OutboxSender started for the handler's own outbox, or None if
+        the outbox was passed in (and so is someone else's to deliver from)
     """
 
+    def __init__(self, outbox=None):
+        """
+        Initialises the event handler
+
+        outbox
+            (Optional) The Outbox to spool alerts to. If None, one will be
+            opened in config.SPOOL_DIR, with a sender of its own to deliver
+            from it
+        """
+        self.sender = None
+        if outbox is None:
+            outbox      = Outbox()
+            self.sender = OutboxSender(outbox)
+            self.sender.start()
+
+        self.outbox = outbox
+
     def notify(self, notifier, event=None):
         """
         Called by notifiers when an event is fired.
@@ -44,22 +70,134 @@ class EventHandler(Listener):
         if config.ALERTS.has_key(event.eventType):
             logging.info("Sending alerts for event type " + event.eventType)
             alertBody = config.ALERTS[event.eventType] % (str(notifier), now)
+            self.sendAlert(alertBody)
+
+    def sendAlert(self, emailBody, smsBody=None):
+        """
+        Spools an alert for every recipient; the outbox's sender takes it from
+        there. A failure here mustn't stop the other listeners being notified,
+        so it's logged rather than raised
+
+        emailBody
+            The text of the alert to email
+
+        smsBody
+            (Optional) The text of the alert to send by SMS. If None, the
+            emailBody is used
+        """
+        if smsBody is None: smsBody = emailBody
 
-            # Send out the alerts
-            # By email
-            smtp = smtplib.SMTP(config.SMTP_HOST)
+        try:
             for recipient in config.RECIPIENTS['email']:
-                logging.debug("Sending alert email to " + recipient)
-                smtp.sendmail(config.FROM_ADDR, recipient, alertBody)
-            smtp.quit()
-
-            # And by SMS, using the MobServ XML-RPC web service
-            try:
-                server = xmlrpclib.ServerProxy(config.XMLRPC_SERVER)
-                for recipient in config.RECIPIENTS['sms']:
-                    logging.debug("Sending alert sms to " + recipient)
-                    continue
-                    server.neit.sendSMS(config.FROM_MSISDN, recipient, alertBody)
-            except xmlrpclib.ProtocolError, err:
-                logging.error("Unable to send SMS through MobServ: " + err)
+                logging.debug("Queueing alert email to " + recipient)
+                self.outbox.put('email', recipient, emailBody)
+
+            for recipient in config.RECIPIENTS['sms']:
+                logging.debug("Queueing alert sms to " + recipient)
+                self.outbox.put('sms', recipient, smsBody)
+        except (IOError, OSError), e:
+            logging.error("Unable to spool alert: " + str(e))
+
+class DigestEventHandler(EventHandler):
+    """
+    An EventHandler that, rather than alerting on every event, collects the
+    events fired during an iteration of the main loop and sends them out as
+    a single digest when flush() is called. Events are grouped by host and
+    event type, so a wide outage costs one email and one SMS per recipient.
+
+    Properties:
+
+    pending
+        The alertable events collected since the last flush, as a list of
+        (host name, event type, entity name, time) tuples
+    """
+
+    def __init__(self, outbox=None):
+        """
+        Initialises the handler
+
+        outbox
+            (Optional) The Outbox to spool alerts to. If None, one will be
+            opened in config.SPOOL_DIR
+        """
+        EventHandler.__init__(self, outbox)
+        self.pending   = []
+
+    def notify(self, notifier, event=None):
+        """
+        Called by notifiers when an event is fired. Alertable events are
+        held until the next flush()
+
+        notifier
+            The object that sent the notification
+
+        event
+            The event we're being notified about
+        """
+        Listener.notify(self, notifier, event)
+        if event is None: return
+
+        logging.debug("DigestEventHandler notified of event " + event.eventType
+                      + " by notifier " + str(notifier))
+
+        if config.ALERTS.has_key(event.eventType):
+            # Work out which host the notifier belongs to
+            host = notifier
+            while getattr(host, 'owner', None) is not None:
+                host = host.owner
+
+            self.pending.append((host.name, event.eventType, notifier.name,
+                                 datetime.now()))
+
+    def flush(self):
+        """
+        Sends out a digest of all the events collected since the last flush,
+        if there were any
+        """
+        if not self.pending: return
+
+        events       = self.pending
+        self.pending = []
+
+        # Group the events by host and event type, keeping the order in
+        # which we first saw each group
+        groups = {}
+        order  = []
+        for hostName, eventType, name, when in events:
+            key = (hostName, eventType)
+            if not groups.has_key(key):
+                groups[key] = []
+                order.append(key)
+            groups[key].append(name)
+
+        logging.info("Sending digest of %d events in %d groups" \
+                     % (len(events), len(order)))
+
+        start = events[0][3].strftime(config.DATE_FORMAT)
+        end   = events[-1][3].strftime(config.DATE_FORMAT)
+        hosts = len(set([hostName for hostName, eventType in order]))
+
+        # The email gets everything
+        summary = {'count': len(events), 'hosts': hosts,
+                   'start': start, 'end': end}
+        body    = [config.DIGEST_HEADER % summary]
+        for hostName, eventType in order:
+            names = groups[(hostName, eventType)]
+            body.append(config.DIGEST_LINE % {'host': hostName,
+                                              'eventType': eventType,
+                                              'count': len(names),
+                                              'names': ", ".join(names)})
+
+        # The SMS gets as much as will fit
+        sms = config.DIGEST_SMS_HEADER % summary
+        for hostName, eventType in order:
+            line = config.DIGEST_SMS_LINE \
+                   % {'host': hostName, 'eventType': eventType,
+                      'count': len(groups[(hostName, eventType)])}
+            if len(sms) + len(line) > config.SMS_MAX_LENGTH:
+                sms = sms[:config.SMS_MAX_LENGTH - 3] + "..."
+                break
+            sms += line
 
+        sms = sms[:config.SMS_MAX_LENGTH]
+        self.sendAlert("\n".join(body), sms)
@@ -0,0 +1,508 @@
+"""
+A durable outbox for Agrona's alerts. Alerts are spooled to disk and
+delivered by a background sender, so a slow or broken gateway can't hold
+up the main loop or lose an alert
+"""
+from   threading import Thread, Lock, Event
+import cPickle
+import logging
+import os
+import random
+import time
+import config
+
+class SpoolError(Exception):
+    """Raised when the outbox's spool directory can't be used"""
+
+class Alert:
+    """
+    A single alert waiting to be delivered
+
+    Properties:
+
+    kind
+        How the alert is to be sent; either 'email' or 'sms'
+
+    recipient
+        The email address or MSISDN to send the alert to
+
+    body
+        The text of the alert
+
+    attempts
+        The number of times we've tried (and failed) to deliver the alert
+
+    nextAttempt
+        The time (in seconds since the epoch) before which we won't try to
+        deliver the alert again
+    """
+
+    def __init__(self, kind, recipient, body):
+        """
+        Creates a new Alert, due for delivery immediately
+
+        kind
+            Either 'email' or 'sms'
+
+        recipient
+            The email address or MSISDN to send the alert to
+
+        body
+            The text of the alert
+        """
+        self.kind        = kind
+        self.recipient   = recipient
+        self.body        = body
+        self.created     = time.time()
+        self.attempts    = 0
+        self.nextAttempt = self.created
+        self.filename    = None
+
+    def __str__(self):
+        return "Alert (%s) to %s" % (self.kind, self.recipient)
+
+class Outbox:
+    """
+    The on-disk spool of alerts waiting to be delivered. Each alert lives in
+    its own file, so the spool survives a restart of the daemon; the file is
+    only removed once the alert has been delivered or abandoned.
+
+    Properties:
+
+    directory
+        The directory in which the alerts are spooled
+
+    maxAlerts
+        The most alerts the spool will hold. Once full, the oldest alert is
+        dropped to make room for each new one
+    """
+
+    def __init__(self, directory=None, maxAlerts=None):
+        """
+        Opens the spool, creating its directory if necessary and loading any
+        alerts left over from a previous run
+
+        directory
+            (Optional) The spool directory. Defaults to config.SPOOL_DIR
+
+        maxAlerts
+            (Optional) The size limit of the spool. Defaults to
+            config.SPOOL_MAX_ALERTS
+        """
+        if directory is None: directory = config.SPOOL_DIR
+        if maxAlerts is None: maxAlerts = config.SPOOL_MAX_ALERTS
+
+        self.directory = directory
+        self.maxAlerts = maxAlerts
+        self.alerts    = []
+        self.waiting   = Event()
+        self._lock     = Lock()
+        self._seq      = 0
+
+        try:
+            if not os.path.isdir(directory): os.makedirs(directory)
+        except OSError, e:
+            raise SpoolError("Unable to create spool directory %s: %s" \
+                             % (directory, e))
+
+        self._load()
+
+    def _load(self):
+        """
+        Reads back any alerts already in the spool directory
+        """
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.alert'): continue
+
+            path = os.path.join(self.directory, filename)
+            try:
+                spooled = open(path, 'rb')
+                try:
+                    alert = cPickle.load(spooled)
+                finally:
+                    spooled.close()
+            except Exception, e:
+                logging.error("Discarding unreadable spooled alert %s: %s" \
+                              % (filename, e))
+                self._unlink(filename)
+                continue
+
+            alert.filename = filename
+            self.alerts.append(alert)
+
+        if self.alerts:
+            logging.info("Loaded %d undelivered alerts from %s" \
+                         % (len(self.alerts), self.directory))
+            self.waiting.set()
+
+    def _write(self, alert):
+        """
+        Writes an alert to its spool file. We write to a temporary file
+        and then rename it, so a crash can never leave half an alert behind
+        """
+        path = os.path.join(self.directory, alert.filename)
+        tmp  = path + '.tmp'
+
+        spooled = open(tmp, 'wb')
+        try:
+            cPickle.dump(alert, spooled, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            spooled.close()
+        os.rename(tmp, path)
+
+    def _unlink(self, filename):
+        """
+        Removes a spool file, ignoring it if it's already gone
+        """
+        try:
+            os.unlink(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+
+    def put(self, kind, recipient, body):
+        """
+        Adds a new alert to the spool and wakes up the sender
+
+        kind
+            Either 'email' or 'sms'
+
+        recipient
+            The email address or MSISDN to send the alert to
+
+        body
+            The text of the alert
+        """
+        alert = Alert(kind, recipient, body)
+
+        self._lock.acquire()
+        try:
+            self._seq += 1
+            alert.filename = "%017.6f-%06d.alert" % (alert.created, self._seq)
+            self._write(alert)
+            self.alerts.append(alert)
+
+            # Keep the spool bounded; the oldest alerts are the least useful
+            while len(self.alerts) > self.maxAlerts:
+                dropped = self.alerts.pop(0)
+                logging.error("Spool full; dropping " + str(dropped))
+                self._unlink(dropped.filename)
+        finally:
+            self._lock.release()
+
+        self.waiting.set()
+        return alert
+
+    def due(self, now=None):
+        """
+        Returns the alerts whose next delivery attempt is due, oldest first
+
+        now
+            (Optional) The time to check against. Defaults to the current
+            time
+        """
+        if now is None: now = time.time()
+
+        self._lock.acquire()
+        try:
+            return [a for a in self.alerts if a.nextAttempt <= now]
+        finally:
+            self._lock.release()
+
+    def nextDue(self):
+        """
+        Returns the time at which the next alert is due, or None if the spool
+        is empty
+        """
+        self._lock.acquire()
+        try:
+            if not self.alerts: return None
+            return min([a.nextAttempt for a in self.alerts])
+        finally:
+            self._lock.release()
+
+    def remove(self, alert):
+        """
+        Takes an alert out of the spool, once it's been delivered or we've
+        given up on it
+
+        alert
+            The Alert to remove
+        """
+        self._lock.acquire()
+        try:
+            if alert in self.alerts: self.alerts.remove(alert)
+            self._unlink(alert.filename)
+        finally:
+            self._lock.release()
+
+    def reschedule(self, alert, delay):
+        """
+        Records a failed delivery attempt and pushes the alert's next attempt
+        back
+
+        alert
+            The Alert that couldn't be delivered
+
+        delay
+            The number of seconds to wait before trying again
+        """
+        self._lock.acquire()
+        try:
+            alert.attempts   += 1
+            alert.nextAttempt = time.time() + delay
+
+            # It may have been dropped from a full spool while we were busy
+            if alert in self.alerts: self._write(alert)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self.alerts)
+
+class CircuitBreaker:
+    """
+    Keeps track of failures for a single destination. Once a destination
+    has failed too many times in a row the breaker opens, and nothing is
+    sent there until it has had a while to recover.
+
+    Properties:
+
+    name
+        The destination that the breaker protects
+
+    failures
+        The number of consecutive failed deliveries
+
+    openedAt
+        The time at which the breaker opened, or None if it's closed
+    """
+
+    def __init__(self, name, threshold=None, resetTime=None):
+        """
+        Creates a new, closed, CircuitBreaker
+
+        name
+            The destination that the breaker protects
+
+        threshold
+            (Optional) Consecutive failures before the breaker opens.
+            Defaults to config.BREAKER_FAILURES
+
+        resetTime
+            (Optional) Seconds an open breaker waits before letting a trial
+            delivery through. Defaults to config.BREAKER_RESET
+        """
+        if threshold is None: threshold = config.BREAKER_FAILURES
+        if resetTime is None: resetTime = config.BREAKER_RESET
+
+        self.name      = name
+        self.threshold = threshold
+        self.resetTime = resetTime
+        self.failures  = 0
+        self.openedAt  = None
+
+    def allow(self, now=None):
+        """
+        Returns True if a delivery to this destination may be attempted. An
+        open breaker lets a single trial delivery through once its reset time
+        has passed
+        """
+        if self.openedAt is None: return True
+        if now is None: now = time.time()
+        return now - self.openedAt >= self.resetTime
+
+    def reopensAt(self):
+        """
+        Returns the time at which an open breaker will next allow a delivery,
+        or None if the breaker is closed
+        """
+        if self.openedAt is None: return None
+        return self.openedAt + self.resetTime
+
+    def success(self):
+        """Records a successful delivery, closing the breaker"""
+        if self.openedAt is not None:
+            logging.info("Circuit breaker for %s closed" % self.name)
+        self.failures = 0
+        self.openedAt = None
+
+    def failure(self, now=None):
+        """Records a failed delivery, opening the breaker if need be"""
+        if now is None: now = time.time()
+        self.failures += 1
+
+        # A failed trial delivery re-opens the breaker for another period
+        if self.openedAt is not None or self.failures >= self.threshold:
+            if self.openedAt is None:
+                logging.error("Circuit breaker for %s opened after %d failures" \
+                              % (self.name, self.failures))
+            self.openedAt = now
+
+def _timeoutTransport():
+    """
+    Returns an XML-RPC transport for the SMS gateway that gives up after
+    config.SEND_TIMEOUT seconds, as SMTP does. Without one, a gateway that
+    accepts a connection and never replies would stall every delivery
+    """
+    import xmlrpclib
+
+    if config.XMLRPC_SERVER.lower().startswith('https:'):
+        base = xmlrpclib.SafeTransport
+    else:
+        base = xmlrpclib.Transport
+
+    class TimeoutTransport(base):
+        def make_connection(self, host):
+            conn = base.make_connection(self, host)
+            conn.timeout = config.SEND_TIMEOUT
+            return conn
+
+    return TimeoutTransport()
+
+class OutboxSender(Thread):
+    """
+    A background thread that delivers the alerts in an Outbox, retrying
+    failures with exponential backoff and jitter
+    """
+
+    def __init__(self, outbox):
+        """
+        Creates a new sender for the given outbox. Call start() to set it
+        going
+
+        outbox
+            The Outbox to deliver alerts from
+        """
+        Thread.__init__(self, name="OutboxSender")
+        self.setDaemon(True)
+
+        self.outbox   = outbox
+        self.running  = False
+        self.breakers = {
+            'email' : CircuitBreaker('email (%s)' % config.SMTP_HOST),
+            'sms'   : CircuitBreaker('sms (%s)' % config.XMLRPC_SERVER),
+        }
+        self._smtp    = None
+        self._sms     = None
+
+    def backoff(self, attempts):
+        """
+        Returns the number of seconds to wait before the next attempt at an
+        alert that has failed the given number of times. The delay doubles
+        with each attempt, up to config.RETRY_MAX, and is jittered so that a
+        backlog of alerts doesn't all retry at once
+        """
+        delay = min(config.RETRY_MAX, config.RETRY_BASE * (2 ** attempts))
+        return random.uniform(delay / 2.0, delay)
+
+    def run(self):
+        """
+        Delivers alerts until stop() is called
+        """
+        self.running = True
+        while self.running:
+            self.outbox.waiting.clear()
+
+            # Whatever goes wrong (a full disk, say), the sender has to keep
+            # going, or no alert would ever be sent again
+            try:
+                self.deliverDue()
+            except Exception, e:
+                logging.exception("Delivery pass failed: " + str(e))
+                self.outbox.waiting.wait(config.RETRY_BASE)
+                continue
+
+            # Sleep until the next alert is due, or a new one arrives
+            nextDue = self.outbox.nextDue()
+            if nextDue is None:
+                self.outbox.waiting.wait()
+                continue
+
+            # Anything still due is waiting on an open breaker, so there's no
+            # point waking up before one of them lets us try again
+            now = time.time()
+            if nextDue <= now:
+                reopens = [b.reopensAt() for b in self.breakers.values()
+                           if b.reopensAt() is not None]
+                if reopens: nextDue = max(now, min(reopens))
+            self.outbox.waiting.wait(max(0, nextDue - now))
+
+    def stop(self):
+        """Asks the sender to stop once its current pass is complete"""
+        self.running = False
+        self.outbox.waiting.set()
+
+    def deliverDue(self):
+        """
+        Makes one delivery pass over all the alerts that are currently due
+        """
+        try:
+            for alert in self.outbox.due():
+                breaker = self.breakers[alert.kind]
+                if not breaker.allow(): continue
+
+                try:
+                    self.deliver(alert)
+                except Exception, e:
+                    breaker.failure()
+                    self._disconnect(alert.kind)
+
+                    if alert.attempts + 1 >= config.RETRY_LIMIT:
+                        logging.error("Giving up on %s after %d attempts: %s" \
+                                      % (alert, alert.attempts + 1, e))
+                        self.outbox.remove(alert)
+                    else:
+                        delay = self.backoff(alert.attempts)
+                        logging.warning("Unable to deliver %s (%s); retrying " \
+                                        "in %.0f seconds" % (alert, e, delay))
+                        self.outbox.reschedule(alert, delay)
+                    continue
+
+                breaker.success()
+                self.outbox.remove(alert)
+        finally:
+            self._disconnect('email')
+            self._disconnect('sms')
+
+    def deliver(self, alert):
+        """
+        Sends a single alert. Any exception raised here counts as a failed
+        delivery
+
+        alert
+            The Alert to send
+        """
+        logging.debug("Sending alert %s to %s" % (alert.kind, alert.recipient))
+
+        if alert.kind == 'email':
+            # Connections are kept open for the length of a delivery pass
+            if self._smtp is None:
+                import smtplib
+                self._smtp = smtplib.SMTP(config.SMTP_HOST,
+                                          timeout=config.SEND_TIMEOUT)
+            self._smtp.sendmail(config.FROM_ADDR, alert.recipient, alert.body)
+
+        elif alert.kind == 'sms':
+            # By SMS, using the MobServ XML-RPC web service
+            if self._sms is None:
+                import xmlrpclib
+                self._sms = xmlrpclib.ServerProxy(config.XMLRPC_SERVER,
+                                                  _timeoutTransport())
+            self._sms.neit.sendSMS(config.FROM_MSISDN, alert.recipient,
+                                   alert.body)
+
+        else:
+            raise ValueError("Unknown alert kind " + str(alert.kind))
+
+    def _disconnect(self, kind):
+        """
+        Drops any connection we're holding for the given kind of alert
+        """
+        if kind == 'email' and self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+        elif kind == 'sms':
+            self._sms = None
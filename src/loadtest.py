@@ -0,0 +1,337 @@
+"""
+Load test harness for Agrona's alert pipeline.
+
+Starts local stand-ins for everything Agrona talks to: an HTTP server
+serving a synthetic MWACS feed, an SMTP server, and an XML-RPC server
+providing neit.sendSMS and mwacs.logStatus. The stand-in gateways can be
+given latency and a failure rate. The harness then drives Agrona through a
+number of cycles, with a slice of the fleet failing on each, and reports
+alert throughput, delivery latency and cycle times.
+
+Everything runs on the loopback interface, so no network access is needed:
+
+    python loadtest.py --hosts 200 --procs 5 --fail-fraction 0.5 \\
+                       --smtp-latency 0.05 --smtp-failure-rate 0.1
+"""
+from   SimpleXMLRPCServer import SimpleXMLRPCServer
+from   BaseHTTPServer     import HTTPServer, BaseHTTPRequestHandler
+from   threading          import Thread, Lock, Event
+from   optparse           import OptionParser
+from   xml.sax.saxutils   import quoteattr
+from   agrona             import Agrona
+from   mwacs              import decoding
+from   mwacs.entities     import MWACSHost, MWACSProcess
+from   mwacs.schema       import STATE_RUNNING, STATE_STOPPED, stateName
+import asyncore, logging, random, shutil, smtpd, tempfile, time
+import config
+
+def percentile(values, pct):
+    """
+    Returns the given percentile of a list of numbers, or 0 if it's empty
+    """
+    if not values: return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+class Gateway:
+    """
+    The latency and failure injection shared by the stand-in gateways, and
+    a count of what they've received
+    """
+
+    def __init__(self, latency=0, failureRate=0):
+        """
+        latency
+            Seconds to wait before handling each request
+
+        failureRate
+            The fraction (0 to 1) of requests that should fail
+        """
+        self.latency     = latency
+        self.failureRate = failureRate
+        self.received    = 0
+        self.failed      = 0
+        self._lock       = Lock()
+
+    def handle(self):
+        """
+        Simulates the handling of one request. Returns False if the request
+        should be failed
+        """
+        if self.latency: time.sleep(self.latency)
+
+        self._lock.acquire()
+        try:
+            if random.random() < self.failureRate:
+                self.failed += 1
+                return False
+            self.received += 1
+            return True
+        finally:
+            self._lock.release()
+
+class FakeSMTPServer(smtpd.SMTPServer):
+    """
+    An SMTP server that accepts (or, with failure injection, rejects) mail
+    and throws it away
+    """
+
+    def __init__(self, gateway):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.gateway = gateway
+        self.port    = self.socket.getsockname()[1]
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if not self.gateway.handle(): return "451 Injected failure"
+        return None
+
+class FakeRPCServer(SimpleXMLRPCServer):
+    """
+    An XML-RPC server standing in for both the MobServ SMS web service and
+    the MWACS web service
+    """
+
+    def __init__(self, smsGateway, statusGateway):
+        SimpleXMLRPCServer.__init__(self, ('127.0.0.1', 0), logRequests=False)
+        self.port = self.server_address[1]
+
+        def sendSMS(sender, recipient, body):
+            if not smsGateway.handle(): raise Exception("Injected failure")
+            return True
+
+        def logStatus(name, status, host):
+            if not statusGateway.handle(): raise Exception("Injected failure")
+            return True
+
+        self.register_function(sendSMS,   'neit.sendSMS')
+        self.register_function(logStatus, 'mwacs.logStatus')
+
+class SyntheticFeed:
+    """
+    Builds MWACS feeds for a fleet of hosts, each running the same number of
+    processes. During a failure cycle, a fraction of the fleet's processes
+    flip between running and stopped, so that every failure cycle produces a
+    fresh ProcessStoppedEvent or recovery for each of them.
+    """
+
+    def __init__(self, hosts, procs, failFraction, format):
+        self.hosts        = hosts
+        self.procs        = procs
+        self.failFraction = failFraction
+        self.format       = format
+        self.cycle        = 0
+        self.failing      = False
+
+    def build(self):
+        """
+        Returns the MWACSHosts making up the feed for the current cycle
+        """
+        failing = int(self.hosts * self.failFraction)
+        stopped = self.failing and self.cycle % 2 == 1
+
+        hosts = []
+        for h in range(self.hosts):
+            host       = MWACSHost("host%04d" % h)
+            host.age   = 5
+            host.value = 0.5
+            for p in range(self.procs):
+                if stopped and h < failing: state = STATE_STOPPED
+                else:                       state = STATE_RUNNING
+                host.addProcess(MWACSProcess("proc%02d" % p, state, 5))
+            hosts.append(host)
+
+        return hosts
+
+    def render(self):
+        """
+        Returns the content type and body of the feed for the current cycle
+        """
+        hosts = self.build()
+
+        if self.format == 'json':
+            return 'application/x-mwacs-json', decoding.encodeJSON(hosts)
+        if self.format == 'bin':
+            return 'application/x-mwacs-binary', decoding.encodeBinary(hosts)
+
+        out = ['<?xml version="1.0"?>\n<mwacs>\n']
+        for host in hosts:
+            out.append('<host name=%s age="%d" value="%.2f">\n' \
+                       % (quoteattr(host.name), host.age, host.value))
+            for proc in host.procs.values():
+                out.append('<process name=%s value="%s" age="%d"/>\n' \
+                           % (quoteattr(proc.name), stateName(proc.value),
+                              proc.age))
+            out.append('</host>\n')
+        out.append('</mwacs>\n')
+        return 'text/xml', ''.join(out)
+
+class FeedServer(HTTPServer):
+    """
+    A HTTP server that serves a SyntheticFeed
+    """
+
+    def __init__(self, feed):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                contentType, body = feed.render()
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.port = self.server_address[1]
+
+def serve(target, name):
+    """Runs a server loop in a daemon thread"""
+    thread = Thread(target=target, name=name)
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--hosts', type='int', default=100,
+                      help="hosts in the synthetic fleet [%default]")
+    parser.add_option('--procs', type='int', default=5,
+                      help="processes per host [%default]")
+    parser.add_option('--format', default='xml', choices=('xml', 'json', 'bin'),
+                      help="feed format: xml, json or bin [%default]")
+    parser.add_option('--warmup', type='int', default=3,
+                      help="quiet cycles before the failures start [%default]")
+    parser.add_option('--cycles', type='int', default=10,
+                      help="cycles with failures [%default]")
+    parser.add_option('--fail-fraction', type='float', default=0.5,
+                      help="fraction of hosts whose processes fail [%default]")
+    parser.add_option('--email', type='int', default=2,
+                      help="email recipients [%default]")
+    parser.add_option('--sms', type='int', default=2,
+                      help="SMS recipients [%default]")
+    parser.add_option('--digest', action='store_true', default=False,
+                      help="send digest alerts")
+    parser.add_option('--flap', action='store_true', default=False,
+                      help="turn on flap detection, which suppresses most of "
+                           "the failures' alerts")
+    parser.add_option('--smtp-latency', type='float', default=0.0,
+                      help="seconds the SMTP server takes per message [%default]")
+    parser.add_option('--smtp-failure-rate', type='float', default=0.0,
+                      help="fraction of messages the SMTP server rejects [%default]")
+    parser.add_option('--rpc-latency', type='float', default=0.0,
+                      help="seconds the XML-RPC server takes per call [%default]")
+    parser.add_option('--rpc-failure-rate', type='float', default=0.0,
+                      help="fraction of XML-RPC calls that fail [%default]")
+    parser.add_option('--drain-timeout', type='float', default=60.0,
+                      help="seconds to wait for the outbox to empty [%default]")
+    parser.add_option('--verbose', action='store_true', default=False,
+                      help="show Agrona's log output")
+    options, args = parser.parse_args()
+
+    if options.verbose: logging.basicConfig(level=logging.INFO,
+                                            format=config.LOG_FORMAT)
+    else:               logging.basicConfig(level=logging.CRITICAL)
+
+    # Bring up the stand-ins
+    feed          = SyntheticFeed(options.hosts, options.procs,
+                                  options.fail_fraction, options.format)
+    smtpGateway   = Gateway(options.smtp_latency, options.smtp_failure_rate)
+    smsGateway    = Gateway(options.rpc_latency, options.rpc_failure_rate)
+    statusGateway = Gateway(options.rpc_latency, options.rpc_failure_rate)
+
+    feedServer = FeedServer(feed)
+    smtpServer = FakeSMTPServer(smtpGateway)
+    rpcServer  = FakeRPCServer(smsGateway, statusGateway)
+    serve(feedServer.serve_forever, "FeedServer")
+    stopping = Event()
+    def smtpLoop():
+        while not stopping.isSet(): asyncore.loop(timeout=0.1, count=1)
+    serve(smtpLoop, "SMTPServer")
+    serve(rpcServer.serve_forever, "RPCServer")
+
+    # Point Agrona at them
+    spool = tempfile.mkdtemp(prefix='agrona-loadtest-')
+    config.MWACS_URL     = "http://127.0.0.1:%d/status.php?cType=%s" \
+                           % (feedServer.port, options.format)
+    config.SMTP_HOST     = "127.0.0.1:%d" % smtpServer.port
+    config.XMLRPC_SERVER = "http://127.0.0.1:%d/" % rpcServer.port
+    config.MWACS_WS_URL  = "http://127.0.0.1:%d/" % rpcServer.port
+    config.SPOOL_DIR     = spool
+    config.RETRY_BASE    = 0.1
+    config.RETRY_MAX     = 2
+    config.BREAKER_RESET = 1
+    config.DIGEST_ALERTS = options.digest
+    config.RECIPIENTS    = {
+        'email' : tuple(["oncall%d@example.com" % i for i in range(options.email)]),
+        'sms'   : tuple(["0770090%04d" % i for i in range(options.sms)]),
+    }
+
+    # Flap detection would hide most of the failures we inject, so it's only
+    # on if asked for
+    config.FLAP_DETECTION = options.flap
+
+    try:
+        agrona = Agrona()
+
+        # Time each delivery from the moment the alert was spooled
+        latencies = []
+        deliver   = agrona.sender.deliver
+        def timedDeliver(alert):
+            deliver(alert)
+            latencies.append(time.time() - alert.created)
+        agrona.sender.deliver = timedDeliver
+
+        quietTimes = []
+        failTimes  = []
+        started    = time.time()
+        for i in range(options.warmup + options.cycles):
+            feed.cycle   = i
+            feed.failing = i >= options.warmup
+
+            before = time.time()
+            agrona.cycle()
+            elapsed = time.time() - before
+
+            if feed.failing: failTimes.append(elapsed)
+            else:            quietTimes.append(elapsed)
+        cyclesDone = time.time()
+
+        # Let the outbox empty
+        deadline = time.time() + options.drain_timeout
+        while len(agrona.outbox) and time.time() < deadline:
+            time.sleep(0.05)
+        drained = time.time()
+
+        delivered = len(latencies)
+        print "Feed:         %d hosts x %d processes (%s)" \
+              % (options.hosts, options.procs, options.format)
+        print "Cycles:       %d quiet, %d with failures" \
+              % (len(quietTimes), len(failTimes))
+        print "Flap check:   %s" % (options.flap and "on" or "off")
+        print "Cycle time:   quiet p50 %.3fs  p99 %.3fs" \
+              % (percentile(quietTimes, 50), percentile(quietTimes, 99))
+        print "              failing p50 %.3fs  p99 %.3fs" \
+              % (percentile(failTimes, 50), percentile(failTimes, 99))
+        print "Alerts:       %d delivered, %d left in the outbox" \
+              % (delivered, len(agrona.outbox))
+        print "Injected:     %d SMTP, %d SMS, %d status failures" \
+              % (smtpGateway.failed, smsGateway.failed, statusGateway.failed)
+        if delivered:
+            print "Throughput:   %.1f alerts/s (%.1fs from first cycle to drain)" \
+                  % (delivered / (drained - started), drained - started)
+            print "Latency:      p50 %.3fs  p90 %.3fs  p99 %.3fs  max %.3fs" \
+                  % (percentile(latencies, 50), percentile(latencies, 90),
+                     percentile(latencies, 99), max(latencies))
+        print "Drain time:   %.3fs after the last cycle" % (drained - cyclesDone)
+
+        agrona.sender.stop()
+    finally:
+        stopping.set()
+        feedServer.shutdown()
+        rpcServer.shutdown()
+        shutil.rmtree(spool, True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+The registry of decoders for the formats the MWACS feed can be served in.
+A decoder is a function that takes a file object and yields MWACSHosts
+(complete with their processes and properties) as it decodes them, so any
+format can be used with parsing.parse without the merging or event logic
+knowing the difference.
+
+Besides the original XML, two formats are provided:
+
+json
+    One JSON object per line, each describing a host:
+    {"name": .., "age": .., "value": ..,
+     "properties": [{"name": .., "value": ..}, ..],
+     "processes":  [{"name": .., "value": .., "age": ..,
+                     "properties": [..]}, ..]}
+
+    Process values are state names, as in the XML.
+
+bin
+    The magic string 'MWB2', followed by one record per host. Each record
+    is a 4-byte length and then three parts, laid out so that a record
+    decodes in a handful of calls rather than one per field:
+
+    - a fixed header: the host's age (4-byte int), load (8-byte double),
+      number of properties and number of processes (2 bytes each)
+    - a table with an entry per process: its state (a 1-byte STATE_ code,
+      see mwacs.schema), age (4-byte int) and number of properties
+      (2 bytes)
+    - every string in the record, as UTF-8 separated by NULs: the host's
+      name, its properties' names and values, then each process's name
+      followed by its properties' names and values
+
+    Everything is big-endian
+
+Whatever the format, ages, loads and states are converted to their proper
+types as they're decoded.
+"""
+from   parsing  import readChunks, iterMWACSData
+from   entities import MWACSHost, MWACSProcess, MWACSProperty
+from   schema   import toAge, toLoad, toState, stateName
+from   urlparse import urlparse, parse_qs
+import json
+import struct
+
+class UnknownFormatError(Exception):
+    """Raised when no decoder is registered for a requested format"""
+
+class DecodeError(Exception):
+    """Raised when a feed can't be decoded in its claimed format"""
+
+# Decoders, by format name, and the content types and cType URL parameters
+# that select them
+_decoders     = {}
+_contentTypes = {}
+_cTypes       = {}
+
+# The format to use when neither content type nor URL says otherwise
+DEFAULT_FORMAT = 'xml'
+
+def registerDecoder(name, decoder, contentTypes=(), cTypes=()):
+    """
+    Registers a decoder for a feed format
+
+    name
+        The name of the format
+
+    decoder
+        A function taking a file object and yielding MWACSHosts
+
+    contentTypes
+        (Optional) The content types that the format is served as
+
+    cTypes
+        (Optional) Values of the feed URL's cType parameter that ask for the
+        format
+    """
+    _decoders[name] = decoder
+    for contentType in contentTypes: _contentTypes[contentType.lower()] = name
+    for cType in cTypes:             _cTypes[cType.lower()] = name
+
+def getDecoder(contentType=None, url=None):
+    """
+    Picks the decoder for a feed. The cType parameter of the URL takes
+    precedence, then the content type the feed was served as; failing both,
+    the XML decoder is used
+
+    contentType
+        (Optional) The content type of the feed, e.g. from a HTTP response
+
+    url
+        (Optional) The URL the feed was fetched from
+    """
+    if url is not None:
+        cTypes = parse_qs(urlparse(url)[4]).get('cType')
+        if cTypes:
+            cType = cTypes[0].lower()
+            if not _cTypes.has_key(cType):
+                raise UnknownFormatError("No decoder for cType " + cType)
+            return _decoders[_cTypes[cType]]
+
+    if contentType is not None:
+        contentType = contentType.split(';')[0].strip().lower()
+        if _contentTypes.has_key(contentType):
+            return _decoders[_contentTypes[contentType]]
+
+    return _decoders[DEFAULT_FORMAT]
+
+## JSON ##
+
+def _jsonObject(value, what):
+    """Checks that a piece of decoded JSON is an object, as expected"""
+    if not isinstance(value, dict):
+        raise DecodeError("Bad JSON %s record: expected an object, got %r" \
+                          % (what, value))
+    return value
+
+def _jsonList(value, what):
+    """Checks that a piece of decoded JSON is a list, as expected"""
+    if not isinstance(value, list):
+        raise DecodeError("Bad JSON %s list: expected a list, got %r" \
+                          % (what, value))
+    return value
+
+def _jsonName(record, what):
+    """Returns the name from a decoded JSON record, which must be a string"""
+    name = record.get('name', '')
+    if not isinstance(name, basestring):
+        raise DecodeError("Bad JSON %s record: name %r isn't a string" \
+                          % (what, name))
+    return name
+
+def _jsonProperties(owner, props):
+    """Adds the decoded JSON properties to their owner"""
+    for prop in _jsonList(props, 'property'):
+        prop = _jsonObject(prop, 'property')
+        owner.addProperty(MWACSProperty(_jsonName(prop, 'property') \
+                                        ,prop.get('value', '')))
+
+def iterJSONData(source):
+    """
+    Decodes MWACS data in the line-per-host JSON format, yielding each
+    MWACSHost as its line arrives
+
+    source
+        A file object containing the JSON to decode
+    """
+    pending = ''
+    for chunk in readChunks(source):
+        lines   = (pending + chunk).split('\n')
+        pending = lines.pop()
+
+        for line in lines:
+            if line.strip(): yield _jsonHost(line)
+
+    if pending.strip(): yield _jsonHost(pending)
+
+def _jsonHost(line):
+    """Turns a single line of JSON into an MWACSHost"""
+    try:
+        data = json.loads(line)
+    except ValueError, e:
+        raise DecodeError("Bad JSON host record: " + str(e))
+
+    data         = _jsonObject(data, 'host')
+    mwhost       = MWACSHost(_jsonName(data, 'host'))
+    mwhost.age   = toAge(data.get('age'))
+    mwhost.value = toLoad(data.get('value'))
+    _jsonProperties(mwhost, data.get('properties', []))
+
+    for proc in _jsonList(data.get('processes', []), 'process'):
+        proc   = _jsonObject(proc, 'process')
+        mwproc = MWACSProcess(_jsonName(proc, 'process') \
+                              ,toState(proc.get('value')) \
+                              ,toAge(proc.get('age')))
+        _jsonProperties(mwproc, proc.get('properties', []))
+        mwhost.addProcess(mwproc)
+
+    return mwhost
+
+def encodeJSON(hosts):
+    """
+    Encodes MWACSHosts in the line-per-host JSON format, e.g. for a feed
+    that's moving over from XML
+
+    hosts
+        A list of MWACSHosts to encode
+    """
+    def props(owner):
+        return [{'name': p.name, 'value': p.value}
+                for p in owner.props.values()]
+
+    lines = []
+    for host in hosts:
+        lines.append(json.dumps({
+            'name'       : host.name,
+            'age'        : host.age,
+            'value'      : host.value,
+            'properties' : props(host),
+            'processes'  : [{'name'       : p.name,
+                             'value'      : stateName(p.value),
+                             'age'        : p.age,
+                             'properties' : props(p)}
+                            for p in host.procs.values()],
+        }))
+
+    return '\n'.join(lines) + '\n'
+
+## Binary ##
+
+BINARY_MAGIC = 'MWB2'
+
+_length = struct.Struct('!I')
+_header = struct.Struct('!idHH')    # Host age, load, property and process count
+_entry  = 'BiH'                     # A process's state, age and property count
+
+# The process tables, by number of processes
+_tables = {}
+
+def _table(count):
+    """Returns the Struct for a table of the given number of processes"""
+    table = _tables.get(count)
+    if table is None:
+        table = _tables[count] = struct.Struct('!' + _entry * count)
+    return table
+
+def iterBinaryData(source):
+    """
+    Decodes MWACS data in the length-prefixed binary format, yielding each
+    MWACSHost as its record arrives
+
+    source
+        A file object containing the binary data to decode
+    """
+    buf    = ''
+    header = True
+
+    for chunk in readChunks(source):
+        buf += chunk
+
+        if header:
+            if len(buf) < len(BINARY_MAGIC): continue
+            if buf[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+                raise DecodeError("Not an MWACS binary feed")
+            buf    = buf[len(BINARY_MAGIC):]
+            header = False
+
+        # Decode every complete record we've got
+        offset = 0
+        while len(buf) - offset >= _length.size:
+            length, = _length.unpack_from(buf, offset)
+            if len(buf) - offset - _length.size < length: break
+
+            start   = offset + _length.size
+            offset  = start + length
+            yield _binaryHost(buf[start:offset])
+
+        buf = buf[offset:]
+
+    if header or buf:
+        raise DecodeError("MWACS binary feed ended mid-record")
+
+def _binaryHost(data):
+    """Turns a single binary record into an MWACSHost"""
+    try:
+        age, load, hostProps, procs = _header.unpack_from(data)
+        table   = _table(procs)
+        entries = table.unpack_from(data, _header.size)
+        strings = data[_header.size + table.size:].decode('utf-8') \
+                  .split(u'\0')
+    except struct.error, e:
+        raise DecodeError("Bad binary host record: " + str(e))
+    except UnicodeDecodeError, e:
+        raise DecodeError("Bad binary host record: " + str(e))
+
+    # Every name and value has to be there, and nothing else
+    expected = 1 + 2 * (hostProps + sum(entries[2::3])) + procs
+    if len(strings) != expected:
+        raise DecodeError("Bad binary host record: %d strings where %d were "
+                          "expected" % (len(strings), expected))
+
+    mwhost = MWACSHost(strings[0], age, load)
+    i      = 1
+    for n in xrange(hostProps):
+        mwhost.addProperty(MWACSProperty(strings[i], strings[i + 1]))
+        i += 2
+
+    for n in xrange(0, 3 * procs, 3):
+        mwproc = MWACSProcess(strings[i], entries[n], entries[n + 1])
+        i += 1
+        for m in xrange(entries[n + 2]):
+            mwproc.addProperty(MWACSProperty(strings[i], strings[i + 1]))
+            i += 2
+        mwhost.addProcess(mwproc)
+
+    return mwhost
+
+def encodeBinary(hosts):
+    """
+    Encodes MWACSHosts in the length-prefixed binary format
+
+    hosts
+        A list of MWACSHosts to encode
+    """
+    def strings(owner, out):
+        for prop in owner.props.values():
+            out.append(unicode(prop.name))
+            out.append(unicode(prop.value))
+
+    out = [BINARY_MAGIC]
+    for host in hosts:
+        procs  = host.procs.values()
+        fields = []
+        names  = [unicode(host.name)]
+        strings(host, names)
+
+        for proc in procs:
+            fields.extend([toState(proc.value), toAge(proc.age),
+                           len(proc.props)])
+            names.append(unicode(proc.name))
+            strings(proc, names)
+
+        for name in names:
+            if u'\0' in name:
+                raise ValueError("Can't encode a NUL in " + repr(name))
+
+        record = _header.pack(toAge(host.age), toLoad(host.value),
+                              len(host.props), len(procs)) \
+                 + _table(len(procs)).pack(*fields) \
+                 + u'\0'.join(names).encode('utf-8')
+        out.append(_length.pack(len(record)) + record)
+
+    return ''.join(out)
+
+registerDecoder('xml',  iterMWACSData,
+                contentTypes=('text/xml', 'application/xml'),
+                cTypes=('xml', 'xml2'))
+registerDecoder('json', iterJSONData,
+                contentTypes=('application/json', 'application/x-mwacs-json'),
+                cTypes=('json',))
+registerDecoder('bin',  iterBinaryData,
+                contentTypes=('application/x-mwacs-binary',),
+                cTypes=('bin',))
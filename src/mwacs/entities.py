@@ -2,9 +2,11 @@
 MWACS Entities: Classes that represent the different parts of an MWACS XML
 file
 """
-from event.base import Notifier
+from event.base   import Notifier
+from mwacs.schema import STATE_STOPPED
 
 import config
+import time
 
 class InvalidPropertyError(Exception):
     """
@@ -40,6 +42,16 @@ class MWACSHost(Notifier):
     """
     Represents a host in MWACS output. A host consists of a hostname, a pair
     of dictionaries (processess and properties) and little else
+
+    Properties:
+
+    lastSeen
+        The time (in seconds since the epoch) at which the host last appeared
+        in the MWACS feed
+
+    detector
+        The FlapDetector watching the host's conditions and those of its
+        processes, or None if flap detection is off
     """
 
     def __init__(self, name, age=0, value=0):
@@ -50,15 +62,17 @@ class MWACSHost(Notifier):
            The hostname, as described in the MWACS XML
 
         age
-            The age (time since last reporting in) of the host
+            The age (time since last reporting in) of the host, in seconds
 
         value
-            The arbitrary value (usually load avg.) of the host.
+            The arbitrary value (usually load avg.) of the host, as a float
         """
         Notifier.__init__(self)
-        self.name  = name
-        self.age   = age
-        self.value = value
+        self.detector = None
+        self.name     = name
+        self.age      = age
+        self.value    = value
+        self.lastSeen = time.time()
 
         # Initialise the dicts of processess and properties
         self.props = {}
@@ -84,7 +98,7 @@ class MWACSHost(Notifier):
             self.__dict__[name] = None
 
         # We're only interested in value and age for Hosts
-        if name is 'age':
+        if name == 'age':
             # We need do imports here to avoid circular references
             from events import HostTimeoutEvent
 
@@ -93,12 +107,28 @@ class MWACSHost(Notifier):
             if value != self.age and value > config.TIMEOUT:
                 self.notifyListeners(HostTimeoutEvent(self))
 
-        elif name is 'value':
-            from events import HighLoadAverageEvent
-
-            # We fire an event if the load average has changed and is > than
-            # the upper limit in the config
-            if value != self.value and value > config.LOAD_AVG_HIGH:
+        elif name == 'value':
+            from events import HighLoadAverageEvent, HostFlappingEvent
+
+            # With flap detection, the load has to climb over the upper limit
+            # to raise an event and drop below a lower one to clear it. Only
+            # hosts that are being listened to are watched
+            if self.detector is not None:
+                if self.listeners:
+                    from flapping import ALARM, FLAPPING
+                    action = self.detector.checkLevel(self.name, None, 'load',
+                                                      value,
+                                                      config.LOAD_AVG_HIGH,
+                                                      config.LOAD_AVG_CLEAR,
+                                                      previous=self.value)
+                    if action == ALARM:
+                        self.notifyListeners(HighLoadAverageEvent(self))
+                    elif action == FLAPPING:
+                        self.notifyListeners(HostFlappingEvent(self))
+
+            # Otherwise we fire an event if the load average has changed and
+            # is > than the upper limit in the config
+            elif value != self.value and value > config.LOAD_AVG_HIGH:
                 self.notifyListeners(HighLoadAverageEvent(self))
 
         # Finally, we update the property regardless
@@ -229,6 +259,12 @@ class MWACSProperty(Notifier):
     """
     Represents a single property of an MWACS host, as described in the MWACS
     XML output
+
+    Properties:
+
+    lastSeen
+        The time (in seconds since the epoch) at which the property last
+        appeared in the MWACS feed
     """
 
     def __init__(self, name, value=None, owner=None):
@@ -247,9 +283,10 @@ class MWACSProperty(Notifier):
         """
         Notifier.__init__(self)
 
-        self.name  = name
-        self.value = value
-        self.owner = owner
+        self.name     = name
+        self.value    = value
+        self.owner    = owner
+        self.lastSeen = time.time()
 
     def getOwner(self):
         """
@@ -286,11 +323,12 @@ class MWACSProcess(MWACSProperty):
             MWACS XML
 
         value
-            The initial value for the process
+            The initial value for the process; one of the STATE_ codes in
+            mwacs.schema
 
         age
-            The initial age of the process. This tells us how long it was
-            since the process updated its status file
+            The initial age of the process, in seconds. This tells us how
+            long it was since the process updated its status file
 
         owner
             (Optional) The MWACSHost that owns this process
@@ -320,7 +358,7 @@ class MWACSProcess(MWACSProperty):
             self.__dict__[name] = None
 
         # We're only interested in value and age for Hosts
-        if name is 'age':
+        if name == 'age':
             from events import ProcessTimeoutEvent
 
             # We only fire an event if the age has changed as well as being over
@@ -328,12 +366,31 @@ class MWACSProcess(MWACSProperty):
             if value != self.age and value > config.TIMEOUT:
                 self.notifyListeners(ProcessTimeoutEvent(self))
 
-        elif name is 'value':
-            from events import ProcessStoppedEvent
-
-            # We fire an event if the load average has changed and is > than
-            # the upper limit in the config
-            if value != self.value and value.lower() is not "stopped":
+        elif name == 'value':
+            from events import ProcessStoppedEvent, ProcessFlappingEvent
+
+            # With flap detection (which is up to the host), a process that
+            # keeps stopping and starting is reported once as flapping rather
+            # than every time it stops
+            detector = None
+            if self.__dict__.get('owner') is not None:
+                detector = self.owner.detector
+
+            if detector is not None:
+                if self.listeners:
+                    from flapping import ALARM, FLAPPING
+                    action = detector.check(self.owner.name, self.name,
+                                            'stopped', value == STATE_STOPPED,
+                                            previous=(self.value ==
+                                                      STATE_STOPPED))
+                    if action == ALARM:
+                        self.notifyListeners(ProcessStoppedEvent(self))
+                    elif action == FLAPPING:
+                        self.notifyListeners(ProcessFlappingEvent(self))
+
+            # Otherwise we fire an event if the process has just been
+            # reported stopped
+            elif value != self.value and value == STATE_STOPPED:
                 self.notifyListeners(ProcessStoppedEvent(self))
 
         # Finally, we update the property regardless
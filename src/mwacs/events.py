@@ -41,6 +41,14 @@ class ProcessTimeoutEvent(ProcessEvent):
     """Fired when a process doesn't report in after a given length of time"""
     eventType = "ProcessTimeout"
 
+class ProcessFlappingEvent(ProcessEvent):
+    """Fired when a process keeps stopping and starting"""
+    eventType = "ProcessFlapping"
+
+class ProcessVanishedEvent(ProcessEvent):
+    """Fired when a process is dropped after disappearing from the feed"""
+    eventType = "ProcessVanished"
+
 ## Host-related events ##
 
 class HostEvent(Event):
@@ -69,6 +77,14 @@ class HighLoadAverageEvent(HostEvent):
     """Fired when a host's load average gets too high"""
     eventType = "HighLoadAverage"
 
+class HostFlappingEvent(HostEvent):
+    """Fired when a host's load average keeps going over its limit and back"""
+    eventType = "HostFlapping"
+
+class HostVanishedEvent(HostEvent):
+    """Fired when a host is dropped after disappearing from the feed"""
+    eventType = "HostVanished"
+
 ## Property-related events
 
 class PropertyEvent(Event):
@@ -0,0 +1,236 @@
+"""
+Flap detection for MWACS entities. A process that keeps stopping and
+starting, or a load average hovering around its limit, would otherwise
+raise a fresh event on every crossing. The FlapDetector sits between an
+entity's readings and its events: it only acts on a condition once it has
+held for a minimum dwell time, it gives levels separate thresholds for
+entering and leaving the alarm state, and it keeps a flap score (an
+exponentially decaying count of recent transitions). Once the score gets
+too high, the entity is reported as flapping, once, and its events are
+suppressed until it settles down.
+
+The detector's state lives in flat arrays, indexed by a slot allocated to
+each condition being watched, rather than as attributes on the entities
+"""
+from   array import array
+import time
+import config
+
+# What check() can tell the caller to do
+ALARM    = 1    # The condition has started; fire its event
+CLEAR    = 2    # The condition has stopped
+FLAPPING = 3    # The condition has started flapping; report it
+
+class FlapDetector:
+    """
+    Watches any number of conditions, each identified by a host name, an
+    optional process name and the name of the thing being watched
+
+    Properties:
+
+    dwell
+        Seconds a condition must hold before we act on it
+
+    halfLife
+        Seconds over which a transition's contribution to the flap score
+        halves
+
+    flapStart
+        The flap score at which a condition is considered to be flapping
+
+    flapStop
+        The flap score below which a flapping condition is considered to
+        have settled
+    """
+
+    def __init__(self, dwell=None, halfLife=None, flapStart=None,
+                 flapStop=None):
+        """
+        Creates a new FlapDetector. Any argument left as None is taken from
+        the matching config setting (FLAP_DWELL, FLAP_HALF_LIFE, FLAP_START
+        and FLAP_STOP)
+        """
+        if dwell     is None: dwell     = config.FLAP_DWELL
+        if halfLife  is None: halfLife  = config.FLAP_HALF_LIFE
+        if flapStart is None: flapStart = config.FLAP_START
+        if flapStop  is None: flapStop  = config.FLAP_STOP
+
+        self.dwell     = dwell
+        self.halfLife  = halfLife
+        self.flapStart = flapStart
+        self.flapStop  = flapStop
+
+        # Slots, by host and then by (process, condition)
+        self._slots    = {}
+        self._free     = []
+
+        # The per-slot state
+        self._state    = array('B')    # Whether we're in the alarm state
+        self._raw      = array('B')    # Whether the condition holds right now
+        self._flapping = array('B')    # Whether the condition is flapping
+        self._since    = array('d')    # When the condition last changed
+        self._score    = array('d')    # The flap score...
+        self._scoredAt = array('d')    # ...as of this time
+
+    def _slot(self, host, process, condition, initial, now):
+        """
+        Returns the slot for a condition, allocating one if need be. A new
+        slot starts out in the state given by initial, as if the condition
+        had been holding (or not) for as long as we'd like
+        """
+        conditions = self._slots.setdefault(host, {})
+        slot       = conditions.get((process, condition))
+        if slot is not None: return slot
+
+        if self._free:
+            slot = self._free.pop()
+            self._state[slot]    = initial
+            self._raw[slot]      = initial
+            self._flapping[slot] = 0
+            self._since[slot]    = now
+            self._score[slot]    = 0.0
+            self._scoredAt[slot] = now
+        else:
+            slot = len(self._state)
+            self._state.append(initial)
+            self._raw.append(initial)
+            self._flapping.append(0)
+            self._since.append(now)
+            self._score.append(0.0)
+            self._scoredAt.append(now)
+
+        conditions[(process, condition)] = slot
+        return slot
+
+    def check(self, host, process, condition, raw, now=None, previous=None):
+        """
+        Records the latest reading of a condition and says what, if
+        anything, should be done about it
+
+        host
+            The name of the host the condition belongs to
+
+        process
+            The name of the process the condition belongs to, or None for a
+            host's own conditions
+
+        condition
+            The name of the condition, e.g. 'stopped'
+
+        raw
+            True if the condition currently holds
+
+        now
+            (Optional) The time of the reading. Defaults to the current time
+
+        previous
+            (Optional) True if the condition held at the reading before this
+            one. Only used the first time a condition is checked: whatever
+            state it was already in when we started watching it isn't news,
+            only a change from it is. Defaults to this reading, so a
+            condition that holds from the start raises no alarm
+
+        returns
+            ALARM, CLEAR or FLAPPING, or None if nothing should be done
+        """
+        if now      is None: now      = time.time()
+        if previous is None: previous = raw
+        raw     = raw and 1 or 0
+        slot    = self._slot(host, process, condition, previous and 1 or 0,
+                             now)
+        result  = None
+        settled = False
+
+        # Let the flap score decay since we last looked at it
+        score = self._score[slot]
+        if score:
+            score *= 0.5 ** ((now - self._scoredAt[slot]) / self.halfLife)
+        self._scoredAt[slot] = now
+
+        if raw != self._raw[slot]:
+            self._raw[slot]   = raw
+            self._since[slot] = now
+            score            += 1
+
+            if not self._flapping[slot] and score >= self.flapStart:
+                self._flapping[slot] = 1
+                result               = FLAPPING
+
+        elif self._flapping[slot] and score < self.flapStop:
+            self._flapping[slot] = 0
+            settled              = True
+
+        self._score[slot] = score
+
+        # Only move between states once the condition has held long enough.
+        # While flapping, we follow the condition but keep quiet about it
+        if raw != self._state[slot] and now - self._since[slot] >= self.dwell:
+            self._state[slot] = raw
+            if result is None and not self._flapping[slot]:
+                result = raw and ALARM or CLEAR
+
+        # Something that has settled down in the alarm state is worth hearing
+        # about again
+        elif settled and self._state[slot]:
+            result = ALARM
+
+        return result
+
+    def checkLevel(self, host, process, condition, value, enter, exit,
+                   now=None, previous=None):
+        """
+        As check(), for a condition that's a level crossing a threshold. The
+        condition starts when the value goes above enter, and only stops
+        once it has dropped below exit, so a value hovering around a single
+        threshold doesn't keep setting it off
+
+        value
+            The latest value
+
+        enter
+            The value above which the condition starts
+
+        exit
+            The value below which the condition stops
+
+        previous
+            (Optional) The value at the reading before this one (see
+            check())
+        """
+        slot = self._slots.get(host, {}).get((process, condition))
+        if slot is not None and self._raw[slot]:
+            raw = value > exit
+        else:
+            raw = value > enter
+
+        if previous is not None: previous = previous > enter
+        return self.check(host, process, condition, raw, now, previous)
+
+    def isFlapping(self, host, process, condition):
+        """Returns True if the given condition is currently flapping"""
+        slot = self._slots.get(host, {}).get((process, condition))
+        return slot is not None and bool(self._flapping[slot])
+
+    def forget(self, host, process=None):
+        """
+        Stops watching a host's conditions (or those of one of its
+        processes), freeing their slots for reuse
+
+        host
+            The name of the host
+
+        process
+            (Optional) The name of the process. If None, all the host's
+            conditions, including its processes', are forgotten
+        """
+        conditions = self._slots.get(host)
+        if conditions is None: return
+
+        for key in conditions.keys():
+            if process is None or key[0] == process:
+                self._free.append(conditions.pop(key))
+
+        if not conditions: del self._slots[host]
+
+    def __len__(self):
+        return len(self._state) - len(self._free)
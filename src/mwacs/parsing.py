@@ -2,14 +2,72 @@
 Provides tools for parsing MWACS XML into a series of MWACS objects as
 defined in pywacs.mwacsobjects
 """
-from xml.dom  import minidom
-from entities import MWACSHost, MWACSProcess, MWACSProperty
+from   xml.parsers import expat
+from   threading   import Thread, Event
+from   Queue       import Queue, Full
+from   entities    import MWACSHost, MWACSProcess, MWACSProperty
+from   schema      import toAge, toLoad, toState
+import time
+import config
 
+def readChunks(source, chunkSize=None, depth=None):
+    """
+    Reads a file object in chunks, in a background thread, so that the
+    next chunk is on its way while we're still busy with the last one.
+    Yields each chunk as it arrives.
+
+    source
+        The file object to read from
 
-def parseMWACSData(source):
+    chunkSize
+        (Optional) The size of each read. Defaults to config.FETCH_CHUNK_SIZE
+
+    depth
+        (Optional) The most chunks to read ahead of the consumer. Defaults to
+        config.FETCH_QUEUE_DEPTH
     """
-    Parses MWACS data into a series of MWACSHosts, MWACSProperties and
-    MWACSProcesses.
+    if chunkSize is None: chunkSize = config.FETCH_CHUNK_SIZE
+    if depth     is None: depth     = config.FETCH_QUEUE_DEPTH
+
+    chunks = Queue(depth)
+    done   = Event()
+
+    def offer(item):
+        # Don't block forever if the consumer has gone away
+        while not done.isSet():
+            try:
+                chunks.put(item, True, 1)
+                return
+            except Full:
+                pass
+
+    def reader():
+        try:
+            while not done.isSet():
+                chunk = source.read(chunkSize)
+                offer(chunk)
+                if not chunk: return
+        except Exception, e:
+            offer(e)
+
+    fetcher = Thread(target=reader, name="MWACSReader")
+    fetcher.setDaemon(True)
+    fetcher.start()
+
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception): raise chunk
+            if not chunk: return
+            yield chunk
+    finally:
+        done.set()
+
+def iterMWACSData(source):
+    """
+    Parses MWACS data incrementally, yielding each MWACSHost (complete with
+    its processes and properties) as soon as its closing tag has been read.
+    Only the host currently being parsed is held in memory.
 
     This method expects XML to be in the form described at
     http://www.mobserv.com/mwacs/status.php?cType=xml2
@@ -17,48 +75,76 @@ def parseMWACSData(source):
     source
         A file object containing the MWACS XML to parse
     """
+    parser = expat.ParserCreate()
+    ready  = []    # Hosts that have been completely parsed
+    owners = []    # The host and process we're currently inside, if any
+
+    def start(name, attrs):
+        if name == 'host':
+            mwhost       = MWACSHost(attrs.get('name', ''))
+            mwhost.age   = toAge(attrs.get('age'))
+            mwhost.value = toLoad(attrs.get('value'))
+            owners.append(mwhost)
+
+        elif name == 'process' and owners:
+            mwproc = MWACSProcess(attrs.get('name', '') \
+                                  ,toState(attrs.get('value')) \
+                                  ,toAge(attrs.get('age')))
+            owners.append(mwproc)
+
+        elif name == 'property' and owners:
+            mwprop = MWACSProperty(attrs.get('name', '') \
+                                   ,attrs.get('value', ''))
+            owners[-1].addProperty(mwprop)
+
+    def end(name):
+        if name == 'process' and len(owners) > 1:
+            mwproc = owners.pop()
+            owners[-1].addProcess(mwproc)
+
+        elif name == 'host' and owners:
+            ready.append(owners.pop())
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler   = end
+
+    for chunk in readChunks(source):
+        parser.Parse(chunk, False)
+
+        # Hand over whatever hosts this chunk completed
+        while ready:
+            yield ready.pop(0)
+
+    parser.Parse('', True)
+    while ready:
+        yield ready.pop(0)
+
+def parseMWACSData(source, decoder=None):
+    """
+    Parses MWACS data into a series of MWACSHosts, MWACSProperties and
+    MWACSProcesses.
+
+    By default, this method expects XML to be in the form described at
+    http://www.mobserv.com/mwacs/status.php?cType=xml2
 
-    # Use minidom - why not?
-    parsed = minidom.parse(source)
+    source
+        A file object containing the MWACS XML to parse
+
+    decoder
+        (Optional) The decoder to use for the data, if it isn't XML (see
+        mwacs.decoding)
+    """
+    if decoder is None: decoder = iterMWACSData
 
     # This is what we're going to return in the end
     hosts  = {}
 
-    # Loop through the hosts and make them into MWACSHost instances
-    for host in parsed.getElementsByTagName('host'):
-        mwhost       = MWACSHost(host.getAttribute('name'))
-        mwhost.age   = host.getAttribute('age')
-        mwhost.value = host.getAttribute('value')
-
-        # Deal with the host's properties
-        for prop in host.getElementsByTagName('property'):
-            mwprop = MWACSProperty(prop.getAttribute('name') \
-                                   ,prop.getAttribute('value'))
-            mwhost.addProperty(mwprop)
-
-        # Now its processes
-        for proc in host.getElementsByTagName('process'):
-            mwproc = MWACSProcess(proc.getAttribute('name') \
-                                  ,proc.getAttribute('value') \
-                                  ,proc.getAttribute('age'))
-
-            # Parse the process's properties
-            for prop in proc.getElementsByTagName('property'):
-                pprop = MWACSProperty(prop.getAttribute('name') \
-                                      ,prop.getAttribute('value'))
-                mwproc.addProperty(pprop)
-
-            mwhost.addProcess(mwproc)
-
-        # Finally, stick the host in the dictionary of hosts
+    for mwhost in decoder(source):
         hosts[mwhost.name] = mwhost
 
-    # Clean up our minidom instance (some versions of Python do not support
-    # garbage collection of objects that refer to each other in a cycle)
-    parsed.unlink()
     return hosts
 
-def updateMWACSData(src, hosts):
+def updateMWACSData(src, hosts, decoder=None, changes=None):
     """
     Takes a list of MWACSHosts (and their associated properties, etc)
     and updates them with the latest data from the MWACS Feed
@@ -67,18 +153,31 @@ def updateMWACSData(src, hosts):
         A file object containing the MWACS XML data
     hosts
         The list of MWACSHosts to update
+    decoder
+        (Optional) The decoder to use for the data, if it isn't XML (see
+        mwacs.decoding)
+    changes
+        (Optional) A list to which an ('new', entity) or ('changed', entity)
+        pair is appended for each entity that's added or updated
     """
+    if decoder is None: decoder = iterMWACSData
 
-    # First things first, get the latest MWACS data from the SRC
-    newHosts = parseMWACSData(src)
+    if changes is not None: changed = changes.append
+    else:                   changed = lambda change: None
+
+    now = time.time()
 
     # Then it's a simple case of doing teh loop-de-loop and updating
-    # the existing hosts with the new data. Honest.
-    for hn, nHost in newHosts.items():
+    # the existing hosts with the new data. Honest. Each host is merged as
+    # soon as it's been parsed, while the rest of the feed is still arriving
+    for nHost in decoder(src):
+        hn = nHost.name
+
         # Check that the new host exists in the old hosts list and
         # Add it if it doesn't
         if not hosts.has_key(hn):
             hosts[hn] = nHost
+            changed(('new', nHost))
             continue # No point in staying in the loop after this
 
         # We need a host to work with
@@ -89,40 +188,59 @@ def updateMWACSData(src, hosts):
             # If the host doesn't have the property, add it
             if not host.props.has_key(pn):
                 host.addProperty(nHost.props[pn])
+                changed(('new', nHost.props[pn]))
                 continue
 
             # Update the property's value (its name is immutable)
-            host.props[pn].value = nHost.props[pn].value
+            prop = host.props[pn]
+            if prop.value != nHost.props[pn].value:
+                prop.value = nHost.props[pn].value
+                changed(('changed', prop))
+            prop.lastSeen = now
 
         # Now we do the processes
         for procn, proc in nHost.procs.items():
             # Add it if we ain't got it
             if not host.procs.has_key(procn):
                 host.addProcess(nHost.procs[procn])
+                changed(('new', nHost.procs[procn]))
                 continue
 
             # Update the process's properties
             for pn in proc.props:
-                # If the host doesn't have the property, add it
-                if not host.props.has_key(pn):
+                # If the process doesn't have the property, add it
+                if not host.procs[procn].props.has_key(pn):
                     host.procs[procn].addProperty(proc.props[pn])
+                    changed(('new', proc.props[pn]))
                     continue
 
                 # Update the property's value (its name is immutable)
-                host.procs[procn].props[pn].value = proc.props[pn].value
+                prop = host.procs[procn].props[pn]
+                if prop.value != proc.props[pn].value:
+                    prop.value = proc.props[pn].value
+                    changed(('changed', prop))
+                prop.lastSeen = now
 
             # Update the process itself
-            host.procs[procn].value = proc.value
-            host.procs[procn].age   = proc.age
+            oProc = host.procs[procn]
+            if oProc.value != proc.value or oProc.age != proc.age:
+                changed(('changed', oProc))
+            oProc.value    = proc.value
+            oProc.age      = proc.age
+            oProc.lastSeen = now
 
         # Finally, update the host
-        host.age  = nHost.age
-        hosts[hn] = host
+        if host.age != nHost.age or host.value != nHost.value:
+            changed(('changed', host))
+        host.age      = nHost.age
+        host.value    = nHost.value
+        host.lastSeen = now
+        hosts[hn]     = host
 
     # Und finallisch, return teh hosts
     return hosts
 
-def parse(src, hosts=None):
+def parse(src, hosts=None, decoder=None, changes=None):
     """
     Serves as a wrapper around parseMWACSData and updateMWACSData, so that
     we only need to call this method and it will in turn call those methods
@@ -134,11 +252,19 @@ def parse(src, hosts=None):
     hosts
         A list of MWACSHosts to update. If none, this list will be created
 
+    decoder
+        (Optional) The decoder to use for the data, if it isn't XML (see
+        mwacs.decoding)
+
+    changes
+        (Optional) When updating, a list to which the changes made are
+        appended (see updateMWACSData)
+
     returns
         An updated host list
     """
 
     if hosts is None:
-        return parseMWACSData(src)
+        return parseMWACSData(src, decoder)
     else:
-        return updateMWACSData(src, hosts)
\ No newline at end of file
+        return updateMWACSData(src, hosts, decoder, changes)
\ No newline at end of file
@@ -0,0 +1,385 @@
+"""
+A change feed for other tools that want MWACS state, so that one fetch and
+parse of the feed can serve any number of them.
+
+Subscribers connect to a Unix domain socket and may send a single line of
+JSON giving the hosts they're interested in, as a list of fnmatch-style
+patterns:
+
+    {"hosts": ["web*", "db01"]}
+
+An empty line (or {}) subscribes to every host. At the end of the next
+iteration of the main loop, the subscriber is sent a snapshot of the
+current state, as "snapshot" records, followed by a
+{"op": "sync"} record, and from then on a "new", "changed" or "removed"
+record for each change, as one JSON object per line. For example:
+
+    {"op": "changed", "type": "process", "host": "web01", "process": "httpd",
+     "state": "stopped", "age": 12}
+
+Each subscriber's backlog of records is bounded; a subscriber that can't
+keep up is disconnected rather than being allowed to hold anything up
+"""
+from   entities  import MWACSHost, MWACSProcess
+from   schema    import stateName
+from   threading import Thread, Lock
+from   fnmatch   import fnmatchcase
+from   select    import select, error as select_error
+import errno, json, logging, os, socket, time
+import config
+
+def entityRecord(op, entity):
+    """
+    Describes a change to a single entity as a dictionary
+
+    op
+        What happened to the entity: 'snapshot', 'new', 'changed' or
+        'removed'
+
+    entity
+        The MWACSHost, MWACSProcess or MWACSProperty concerned
+    """
+    if isinstance(entity, MWACSHost):
+        return {'op': op, 'type': 'host', 'host': entity.name,
+                'age': entity.age, 'value': entity.value}
+
+    if isinstance(entity, MWACSProcess):
+        return {'op': op, 'type': 'process', 'host': entity.owner.name,
+                'process': entity.name, 'state': stateName(entity.value),
+                'age': entity.age}
+
+    record = {'op': op, 'type': 'property', 'name': entity.name,
+              'value': entity.value}
+    if isinstance(entity.owner, MWACSProcess):
+        record['host']    = entity.owner.owner.name
+        record['process'] = entity.owner.name
+    else:
+        record['host']    = entity.owner.name
+    return record
+
+def entityRecords(op, entity):
+    """
+    As entityRecord, but for new entities and snapshots also describes
+    everything the entity owns
+    """
+    records = [entityRecord(op, entity)]
+    if op not in ('new', 'snapshot'): return records
+
+    for prop in entity.props.values():
+        records.append(entityRecord(op, prop))
+    for proc in getattr(entity, 'procs', {}).values():
+        records.extend(entityRecords(op, proc))
+
+    return records
+
+class Subscriber:
+    """
+    A single connection to the change feed
+
+    Properties:
+
+    patterns
+        The host name patterns the subscriber is interested in, or None for
+        every host
+
+    subscribed
+        True once the subscriber has sent its subscription
+
+    ready
+        True once the subscriber has been sent its snapshot
+
+    dropped
+        True once the subscriber has been found to be too slow. Its
+        connection is closed by the feed's thread
+    """
+
+    def __init__(self, sock):
+        self.sock       = sock
+        self.patterns   = None
+        self.subscribed = False
+        self.ready      = False
+        self.dropped    = False
+        self.inbuf      = ''    # Unprocessed input from the subscriber
+        self.outbuf     = []    # Lines waiting to be sent
+        self.pending    = ''    # Lines that are partway through being sent
+
+    def wants(self, host):
+        """Returns True if the subscriber is interested in the given host"""
+        if self.patterns is None: return True
+        for pattern in self.patterns:
+            if fnmatchcase(host, pattern): return True
+        return False
+
+class ChangeFeed:
+    """
+    Publishes changes to MWACS entities to subscribers on a Unix domain
+    socket. The socket is serviced by a background thread; publish() is
+    called from the main loop with each iteration's changes
+
+    Properties:
+
+    path
+        The path of the socket
+
+    bufferSize
+        The most records that may be waiting for a subscriber before it's
+        dropped
+    """
+
+    def __init__(self, path=None, bufferSize=None):
+        """
+        Creates the change feed. Call start() to open the socket
+
+        path
+            (Optional) The path of the socket. Defaults to
+            config.CHANGE_FEED_SOCKET
+
+        bufferSize
+            (Optional) The size of each subscriber's backlog. Defaults to
+            config.CHANGE_FEED_BUFFER
+        """
+        if path       is None: path       = config.CHANGE_FEED_SOCKET
+        if bufferSize is None: bufferSize = config.CHANGE_FEED_BUFFER
+
+        self.path        = path
+        self.bufferSize  = bufferSize
+        self.subscribers = []
+        self.running     = False
+        self._lock       = Lock()
+        self._listener   = None
+        self._wakeup     = None
+
+    def start(self):
+        """
+        Opens the socket and starts servicing it in a background thread
+        """
+        if os.path.exists(self.path): os.unlink(self.path)
+
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.path)
+        self._listener.listen(16)
+        self._listener.setblocking(False)
+
+        # A pipe that publish() writes to, to wake the thread up
+        self._wakeup = os.pipe()
+
+        self.running = True
+        thread = Thread(target=self._serve, name="ChangeFeed")
+        thread.setDaemon(True)
+        thread.start()
+        logging.info("Publishing changes on " + self.path)
+
+    def stop(self):
+        """Asks the feed to close its socket and disconnect everyone"""
+        self.running = False
+        self._wake()
+
+    def publish(self, changes, hosts):
+        """
+        Sends the changes from an iteration of the main loop to subscribers,
+        and sends snapshots to anyone who's subscribed since the last one.
+        This must be called from the thread that updates the hosts
+
+        changes
+            A list of (op, entity) pairs, where op is 'new', 'changed' or
+            'removed'
+
+        hosts
+            The dictionary of MWACSHosts, for snapshots
+        """
+        if not self.subscribers: return
+
+        # Encode each record once, however many subscribers get it
+        lines = []
+        for op, entity in changes:
+            for record in entityRecords(op, entity):
+                lines.append((record['host'], json.dumps(record) + '\n'))
+
+        self._lock.acquire()
+        try:
+            for sub in self.subscribers:
+                if not sub.subscribed or sub.dropped: continue
+
+                if not sub.ready:
+                    snapshot = []
+                    for host in hosts.values():
+                        if not sub.wants(host.name): continue
+                        for record in entityRecords('snapshot', host):
+                            snapshot.append(json.dumps(record) + '\n')
+                    snapshot.append(json.dumps({'op': 'sync'}) + '\n')
+                    sub.ready = True
+                    self._queue(sub, snapshot, True)
+                else:
+                    self._queue(sub, [line for host, line in lines
+                                      if sub.wants(host)])
+        finally:
+            self._lock.release()
+
+        self._wake()
+
+    def _queue(self, sub, lines, snapshot=False):
+        """
+        Adds lines to a subscriber's backlog, marking the subscriber to be
+        dropped if the backlog gets too long. Must be called with the lock
+        held
+
+        snapshot
+            True if the lines are the subscriber's snapshot, which may be
+            bigger than the buffer
+        """
+        if not lines: return
+
+        # The backlog includes whatever is still partway through being sent
+        backlog = len(sub.outbuf) + sub.pending.count('\n')
+        if not snapshot and backlog + len(lines) > self.bufferSize:
+            logging.warning("Change feed subscriber too slow; dropping it")
+
+            # The socket may be in the middle of a select() in the feed's
+            # thread, so it's left to that thread to close it
+            sub.dropped = True
+            sub.outbuf  = []
+            sub.pending = ''
+            return
+
+        sub.outbuf.extend(lines)
+
+    def _drop(self, sub):
+        """
+        Disconnects a subscriber. Must be called with the lock held, from
+        the feed's thread
+        """
+        if sub in self.subscribers: self.subscribers.remove(sub)
+        try:
+            sub.sock.close()
+        except socket.error:
+            pass
+
+    def _wake(self):
+        if self._wakeup is not None:
+            try:
+                os.write(self._wakeup[1], 'x')
+            except OSError:
+                pass
+
+    def _serve(self):
+        """
+        The socket loop: accepts subscribers, reads their subscriptions and
+        writes out their backlogs
+        """
+        while self.running:
+            # Whatever goes wrong, the feed has to keep going, or no one
+            # would hear from it again
+            try:
+                self._serveOnce()
+            except Exception, e:
+                logging.exception("Change feed failed: " + str(e))
+                time.sleep(1)
+
+        # Shut up shop
+        self._lock.acquire()
+        try:
+            for sub in self.subscribers[:]: self._drop(sub)
+            self._listener.close()
+            os.close(self._wakeup[0])
+            os.close(self._wakeup[1])
+            self._wakeup = None
+            if os.path.exists(self.path): os.unlink(self.path)
+        finally:
+            self._lock.release()
+
+    def _serveOnce(self):
+        """
+        A single pass of the socket loop
+        """
+        self._lock.acquire()
+        try:
+            # Only this thread closes sockets, so none of these can be
+            # closed under select()
+            for sub in self.subscribers[:]:
+                if sub.dropped: self._drop(sub)
+
+            readers = [self._listener, self._wakeup[0]] + \
+                      [s.sock for s in self.subscribers]
+            writers = [s.sock for s in self.subscribers
+                       if s.outbuf or s.pending]
+        finally:
+            self._lock.release()
+
+        try:
+            readable, writable, broken = select(readers, writers, [], 5)
+        except (socket.error, select_error), e:
+            if e.args[0] == errno.EINTR: return
+            raise
+
+        self._lock.acquire()
+        try:
+            bySock = dict([(s.sock, s) for s in self.subscribers])
+
+            for sock in readable:
+                if sock is self._listener:
+                    self._accept()
+                elif sock == self._wakeup[0]:
+                    os.read(self._wakeup[0], 4096)
+                elif bySock.has_key(sock):
+                    self._read(bySock[sock])
+
+            for sock in writable:
+                sub = bySock.get(sock)
+                if sub in self.subscribers and not sub.dropped:
+                    self._write(sub)
+        finally:
+            self._lock.release()
+
+    def _accept(self):
+        try:
+            sock, address = self._listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        self.subscribers.append(Subscriber(sock))
+
+    def _read(self, sub):
+        """Reads a subscriber's subscription line"""
+        try:
+            data = sub.sock.recv(4096)
+        except socket.error:
+            data = ''
+
+        if not data:
+            self._drop(sub)
+            return
+
+        if sub.subscribed: return   # We don't expect anything more
+
+        sub.inbuf += data
+        if '\n' not in sub.inbuf:
+            if len(sub.inbuf) > 65536: self._drop(sub)
+            return
+
+        line = sub.inbuf.split('\n', 1)[0].strip()
+        try:
+            request = line and json.loads(line) or {}
+            if request.has_key('hosts'):
+                sub.patterns = [str(p) for p in request['hosts']]
+        except (ValueError, AttributeError, TypeError):
+            logging.warning("Bad change feed subscription: %r" % line)
+            self._drop(sub)
+            return
+
+        sub.subscribed = True
+        sub.inbuf      = ''
+
+    def _write(self, sub):
+        """Sends as much of a subscriber's backlog as it will take"""
+        if not sub.pending:
+            sub.pending = ''.join(sub.outbuf)
+            sub.outbuf  = []
+
+        try:
+            sent = sub.sock.send(sub.pending)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+            self._drop(sub)
+            return
+
+        sub.pending = sub.pending[sent:]
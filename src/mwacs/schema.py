@@ -0,0 +1,72 @@
+"""
+The types of the fields in the MWACS feed. Every decoder converts ages,
+load averages and process states once, as the feed is decoded, so that the
+rest of Agrona only ever deals with ints, floats and state codes
+"""
+import logging
+
+# Process states, as compact integer codes
+STATE_UNKNOWN = 0
+STATE_RUNNING = 1
+STATE_STOPPED = 2
+
+STATES = {
+    'running' : STATE_RUNNING,
+    'stopped' : STATE_STOPPED,
+}
+
+_stateNames = dict([(code, name) for name, code in STATES.items()])
+_stateNames[STATE_UNKNOWN] = 'unknown'
+
+def toAge(raw):
+    """
+    Converts an age (the number of seconds since an entity last reported in)
+    to an int. Missing or malformed ages are taken as 0
+
+    raw
+        The age as it appears in the feed
+    """
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        if raw not in (None, ''): logging.warning("Bad age in feed: %r" % raw)
+        return 0
+
+def toLoad(raw):
+    """
+    Converts a host's value (its load average) to a float. Missing or
+    malformed values are taken as 0.0
+
+    raw
+        The value as it appears in the feed
+    """
+    try:
+        return float(raw)
+    except (TypeError, ValueError):
+        if raw not in (None, ''): logging.warning("Bad load in feed: %r" % raw)
+        return 0.0
+
+def toState(raw):
+    """
+    Converts a process's value (its state) to one of the STATE_ codes.
+    Codes are passed through as they are; unrecognised states become
+    STATE_UNKNOWN
+
+    raw
+        The state as it appears in the feed
+    """
+    if isinstance(raw, int): return raw
+    if raw is None:          return STATE_UNKNOWN
+    if not isinstance(raw, basestring):
+        logging.warning("Bad state in feed: %r" % raw)
+        return STATE_UNKNOWN
+    return STATES.get(raw.strip().lower(), STATE_UNKNOWN)
+
+def stateName(code):
+    """
+    Returns the name of a STATE_ code, as it would appear in the feed
+
+    code
+        The state code
+    """
+    return _stateNames.get(code, 'unknown')
@@ -0,0 +1,137 @@
+"""
+Eviction of MWACS entities that have vanished from the feed. Hosts,
+processes and properties that haven't been seen for longer than their TTL
+are dropped, a few hosts at a time, so that the registry tracks the live
+fleet without any one cycle paying for a full pass over it
+"""
+from   mwacs.events import HostVanishedEvent, ProcessVanishedEvent
+import logging
+import time
+import config
+
+class Sweeper:
+    """
+    Incrementally sweeps a dictionary of MWACSHosts for stale entities.
+
+    Each call to sweep() looks at the next batch of hosts (and everything
+    they own); once every host has been looked at, the next call starts a
+    fresh pass.
+
+    Properties:
+
+    hostTTL
+        Seconds a host may go unseen before it is dropped
+
+    processTTL
+        Seconds a process or property may go unseen before it is dropped
+
+    batchSize
+        The number of hosts looked at by each call to sweep()
+
+    fireEvents
+        If True, HostVanishedEvents and ProcessVanishedEvents are sent to the
+        entities' listeners as they're dropped
+
+    detector
+        The FlapDetector to forget dropped hosts and processes in, if any
+    """
+
+    def __init__(self, hostTTL=None, processTTL=None, batchSize=None,
+                 fireEvents=None, detector=None):
+        """
+        Creates a new Sweeper. Any argument left as None is taken from the
+        matching config setting (HOST_TTL, PROCESS_TTL, SWEEP_BATCH and
+        VANISHED_EVENTS), apart from detector, which is simply left out
+        """
+        if hostTTL    is None: hostTTL    = config.HOST_TTL
+        if processTTL is None: processTTL = config.PROCESS_TTL
+        if batchSize  is None: batchSize  = config.SWEEP_BATCH
+        if fireEvents is None: fireEvents = config.VANISHED_EVENTS
+
+        self.hostTTL    = hostTTL
+        self.processTTL = processTTL
+        self.batchSize  = batchSize
+        self.fireEvents = fireEvents
+        self.detector   = detector
+
+        # The host names still to be looked at in the current pass
+        self._pending   = []
+
+    def sweep(self, hosts, now=None):
+        """
+        Looks at the next batch of hosts, removing any stale hosts, processes
+        and properties from them
+
+        hosts
+            The dictionary of MWACSHosts to sweep. Stale hosts are removed
+            from it in place
+
+        now
+            (Optional) The time to measure staleness against. Defaults to
+            the current time
+
+        returns
+            A list of the entities that were removed
+        """
+        if now is None: now = time.time()
+
+        # Start a new pass once the last one is done. Taking a copy of the
+        # names means hosts coming and going mid-pass can't upset us
+        if not self._pending:
+            self._pending = hosts.keys()
+
+        batch         = self._pending[-self.batchSize:]
+        self._pending = self._pending[:-self.batchSize]
+        removed       = []
+
+        for hn in batch:
+            host = hosts.get(hn)
+            if host is None: continue
+
+            if now - host.lastSeen > self.hostTTL:
+                logging.info("%s not seen for %d seconds; dropping it" \
+                             % (host, now - host.lastSeen))
+                if self.fireEvents:
+                    host.notifyListeners(HostVanishedEvent(host))
+                del hosts[hn]
+                if self.detector is not None: self.detector.forget(hn)
+                removed.append(host)
+                continue
+
+            removed.extend(self._sweepProps(host.props, now))
+
+            for procn, proc in host.procs.items():
+                if now - proc.lastSeen > self.processTTL:
+                    logging.info("%s not seen for %d seconds; dropping it" \
+                                 % (proc, now - proc.lastSeen))
+                    if self.fireEvents:
+                        proc.notifyListeners(ProcessVanishedEvent(proc))
+                    del host.procs[procn]
+                    if self.detector is not None:
+                        self.detector.forget(hn, proc.name)
+                    removed.append(proc)
+                    continue
+
+                removed.extend(self._sweepProps(proc.props, now))
+
+        # Drop the dead entities' references to their listeners, so that
+        # nothing we've let go of is kept alive through a cycle
+        for entity in removed:
+            entity.listeners = []
+
+        return removed
+
+    def _sweepProps(self, props, now):
+        """
+        Removes stale properties from a dictionary of MWACSProperties, and
+        returns a list of those removed
+        """
+        removed = []
+        for pn, prop in props.items():
+            if now - prop.lastSeen > self.processTTL:
+                logging.debug("%s not seen for %d seconds; dropping it" \
+                              % (prop, now - prop.lastSeen))
+                del props[pn]
+                removed.append(prop)
+
+        return removed
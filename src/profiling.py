@@ -0,0 +1,187 @@
+"""
+Memory profiling for long-running Agrona daemons.
+
+When config.PROFILE_MEMORY is set, a CycleProfiler takes a look at memory
+use every config.PROFILE_EVERY iterations of the main loop, and writes to a
+rotating log:
+
+- the number of hosts, processes, properties and listener references in
+  the registry
+- the kinds of object the garbage collector knows about whose counts have
+  grown the most since the last look
+- if config.PROFILE_TRACE is set and tracemalloc is available (built in
+  from Python 3.4, or the pytracemalloc backport), the allocation sites
+  that have grown the most since the last look
+
+Object counts are only taken every so often, so they're cheap enough to
+leave on in production. tracemalloc is another matter: once started, it
+traces every allocation between snapshots too, which slows everything
+down and costs memory of its own. It's best kept for hunting down a leak
+that the object counts have turned up
+"""
+from   logging.handlers import RotatingFileHandler
+import gc, logging, os, resource
+import config
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def countEntities(hosts):
+    """
+    Counts what's in the registry of hosts, returning a dictionary of counts
+    of hosts, processes, properties and listener references
+
+    hosts
+        The dictionary of MWACSHosts
+    """
+    counts = {'hosts': 0, 'processes': 0, 'properties': 0, 'listeners': 0}
+
+    for host in hosts.values():
+        counts['hosts']      += 1
+        counts['listeners']  += len(host.listeners)
+        counts['properties'] += len(host.props)
+        for prop in host.props.values():
+            counts['listeners'] += len(prop.listeners)
+
+        for proc in host.procs.values():
+            counts['processes']  += 1
+            counts['listeners']  += len(proc.listeners)
+            counts['properties'] += len(proc.props)
+            for prop in proc.props.values():
+                counts['listeners'] += len(prop.listeners)
+
+    return counts
+
+def countObjects():
+    """
+    Counts the objects tracked by the garbage collector, by class name
+    """
+    counts = {}
+    for obj in gc.get_objects():
+        # Old-style instances are all of type 'instance', so go by class
+        name = getattr(getattr(obj, '__class__', None), '__name__', None)
+        if name is None: name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+
+    return counts
+
+class CycleProfiler:
+    """
+    Takes periodic snapshots of memory use at cycle boundaries and logs how
+    it has changed
+
+    Properties:
+
+    every
+        The number of cycles between snapshots
+
+    top
+        The number of object types and allocation sites to report
+    """
+
+    def __init__(self, every=None, top=None, logFile=None):
+        """
+        Sets up the profiler and its log, creating the log's directory if
+        need be, and starts tracemalloc if it's wanted (config.PROFILE_TRACE)
+        and available. Any argument left as None is taken from the matching
+        config setting (PROFILE_EVERY, PROFILE_TOP and PROFILE_LOG). Raises
+        IOError or OSError if the log can't be opened
+        """
+        if every   is None: every   = config.PROFILE_EVERY
+        if top     is None: top     = config.PROFILE_TOP
+        if logFile is None: logFile = config.PROFILE_LOG
+
+        self.every     = every
+        self.top       = top
+        self.cycles    = 0
+        self._objects  = None
+        self._snapshot = None
+        self.tracing   = False
+
+        # Profiles go to their own log, away from the main one
+        self.log = logging.getLogger('agrona.profile')
+        self.log.propagate = False
+        if not self.log.handlers:
+            directory = os.path.dirname(logFile)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            handler = RotatingFileHandler(logFile,
+                                          maxBytes=config.PROFILE_LOG_SIZE,
+                                          backupCount=config.PROFILE_LOG_COUNT)
+            handler.setFormatter(logging.Formatter(config.LOG_FORMAT))
+            self.log.addHandler(handler)
+        self.log.setLevel(logging.INFO)
+
+        if not config.PROFILE_TRACE: return
+
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(config.PROFILE_FRAMES)
+            self.tracing = True
+        else:
+            logging.info("tracemalloc isn't available; memory profiles will "
+                         "only include object counts")
+
+    def cycle(self, hosts):
+        """
+        Called at the end of every iteration of the main loop. Takes and logs
+        a snapshot every self.every cycles
+
+        hosts
+            The registry of MWACSHosts
+        """
+        self.cycles += 1
+        if self.cycles % self.every: return
+
+        self.snapshot(hosts)
+
+    def snapshot(self, hosts):
+        """
+        Takes a snapshot of memory use and logs how it differs from the last
+
+        hosts
+            The registry of MWACSHosts
+        """
+        log = self.log
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        log.info("Cycle %d: max RSS %d kB" % (self.cycles, usage.ru_maxrss))
+
+        entities = countEntities(hosts)
+        log.info("Registry: %(hosts)d hosts, %(processes)d processes, "
+                 "%(properties)d properties, %(listeners)d listener references"
+                 % entities)
+
+        # Object counts, by type. The first time round there's nothing to
+        # compare with, so we report the most numerous; after that, the ones
+        # that have grown the most, which is where a leak will show up
+        objects = countObjects()
+        if self._objects is None:
+            ranked = sorted(objects.items(), key=lambda item: -item[1])
+            for name, count in ranked[:self.top]:
+                log.info("  %-30s %9d" % (name, count))
+        else:
+            growth = [(count - self._objects.get(name, 0), name, count)
+                      for name, count in objects.items()]
+            growth.sort(reverse=True)
+            for grown, name, count in growth[:self.top]:
+                if grown <= 0: break
+                log.info("  %-30s %9d  %+d" % (name, count, grown))
+        self._objects = objects
+
+        if not self.tracing: return
+
+        # The allocation sites that have grown the most
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+        if self._snapshot is not None:
+            growth = [stat for stat in
+                      snapshot.compare_to(self._snapshot, 'lineno')
+                      if stat.size_diff > 0]
+            for stat in growth[:self.top]:
+                log.info("  %+d B (%+d blocks) at %s" \
+                         % (stat.size_diff, stat.count_diff, stat.traceback))
+        self._snapshot = snapshot